@@ -1,4 +1,39 @@
+import os
+import time
+
 bind = "0.0.0.0:5000"
-workers = 4
-threads = 4
-timeout = 120
\ No newline at end of file
+workers = int(os.getenv('GUNICORN_WORKERS', 4))
+threads = int(os.getenv('GUNICORN_THREADS', 4)) # also the default DB_POOL_SIZE of each worker, see website/config.py
+timeout = 120
+
+# Live streams of /user_data hold their connection open. The default gthread workers spend one of their threads on each,
+# with GUNICORN_WORKER_CLASS=gevent (pip install gevent) they are cheap greenlets and a worker can hold hundreds.
+worker_class = os.getenv('GUNICORN_WORKER_CLASS', 'gthread')
+worker_connections = int(os.getenv('GUNICORN_WORKER_CONNECTIONS', 1000))
+
+# The app is imported once by the master and shared copy-on-write by the forked workers, so adding a worker doesn't
+# re-run create_app. The schema is created by on_starting below, once, instead of by every worker racing at boot.
+preload_app = os.getenv('GUNICORN_PRELOAD', '1') == '1'
+os.environ.setdefault('SCHEMA_INIT_ON_STARTUP', '0')
+
+_started = time.perf_counter()
+
+
+def on_starting(server):
+    from website import db, init_schema
+    app = server.app.wsgi()
+    init_schema(app)
+    # Connections opened in the master must not be shared with the forked workers
+    with app.app_context():
+        db.engine.dispose()
+
+
+def post_fork(server, worker):
+    # Drops any pooled connection inherited from the master without closing it for the other processes
+    from website import db
+    with server.app.wsgi().app_context():
+        db.engine.dispose(close=False)
+
+
+def when_ready(server):
+    server.log.info('Ready to accept requests %.2f s after start', time.perf_counter() - _started)
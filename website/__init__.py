@@ -3,10 +3,9 @@ from flask_sqlalchemy import SQLAlchemy
 from flask_wtf import CSRFProtect  # Import CSRFProtect
 from os import path
 from flask_login import LoginManager
-
-from flask_admin import Admin
-from flask_admin.contrib.sqla import ModelView
-from werkzeug.security import generate_password_hash
+from sqlalchemy import inspect
+from sqlalchemy.engine import make_url
+import time
 
 from .config import Config # this is to setup the config.py for env variables
 
@@ -15,46 +14,95 @@ DB_NAME = "database.db"
 
 
 def create_app():
+    started = time.perf_counter()
     app = Flask(__name__)
     app.config.from_object(Config)
     app.config['SQLALCHEMY_DATABASE_URI'] = app.config['DATABASE_URL'] # This is needed, and doesn't get set in the previous line
-    print("Database Path:", app.config['SQLALCHEMY_DATABASE_URI'])
 
     csrf = CSRFProtect(app)
     csrf.init_app(app)
 
     db.init_app(app)
 
+    from .ingest_queue import ingest_queue
+    ingest_queue.init_app(app)
+
+    from .profiling import profiler
+    profiler.init_app(app) # only active with PROFILING=1
+
+    from . import assets
+    assets.init_app(app) # fingerprinted static files and the image helpers of the templates
+
     from .views import views
     from .auth import auth
     from .user_data import data_view # Zane Addition
+    from .ingest import ingest
 
     # Register Blueprints, Views and Auth (the two files containing the routes)
     app.register_blueprint(views, url_prefix='/')
     app.register_blueprint(auth, url_prefix='/')
     app.register_blueprint(data_view, url_prefix='/') # Zane Addition
+    app.register_blueprint(ingest, url_prefix='/')
+    csrf.exempt(ingest) # devices post JSON with an API key, they don't have a csrf token
 
     from .models import User, Note, Device, DeviceData
-    
-    with app.app_context():
-        db.create_all()
+
+    # In production the schema is created once before the workers start (see gunicorn_config.py or "flask init-db"),
+    # instead of by every worker at the same time
+    if app.config['SCHEMA_INIT_ON_STARTUP']:
+        init_schema(app)
+
+    @app.cli.command('init-db')
+    def init_db_command():
+        # Creates the missing tables and indexes and reports columns the models have but the database lacks
+        missing = init_schema(app)
+        print('Database schema is up to date.' if not missing else 'Missing columns: ' + ', '.join(missing))
 
     login_manager = LoginManager()
     login_manager.login_view = 'auth.login'
     login_manager.init_app(app)
 
-    # Admin setup
-    admin = Admin(app)
-    admin.add_view(ModelView(User, db.session))
-    admin.add_view(ModelView(Device, db.session))
-    admin.add_view(ModelView(DeviceData, db.session))
+    # Admin setup, Flask-Admin is only imported when it is enabled. Set ADMIN_ENABLED=0 on the public workers and run
+    # the admin in its own process if it isn't needed there.
+    if app.config['ADMIN_ENABLED']:
+        from flask_admin import Admin
+        from flask_admin.contrib.sqla import ModelView
+        from .admin_views import DeviceView, DeviceDataView
+        admin = Admin(app)
+        admin.add_view(ModelView(User, db.session))
+        admin.add_view(DeviceView(Device, db.session))
+        admin.add_view(DeviceDataView(DeviceData, db.session))
 
 
     @login_manager.user_loader
     def load_user(id):
-        return User.query.get(int(id))
+        # A cached snapshot (id, email, first_name) instead of a query per request, see db_utils.load_user_snapshot
+        from .db_utils import load_user_snapshot
+        return load_user_snapshot(int(id))
+
+    print(f"App created in {(time.perf_counter() - started) * 1000:.0f} ms, database "
+          f"{make_url(app.config['SQLALCHEMY_DATABASE_URI']).render_as_string(hide_password=True)}")
     return app
 
+def init_schema(app):
+    # Creates the missing tables and indexes, then returns the model columns missing from existing tables
+    # ("table.column"), which create_all doesn't add. Safe to run on every deploy.
+    from .models import DeviceData
+    with app.app_context():
+        db.create_all()
+        # create_all only adds indexes along with new tables, create the ones missing from older databases
+        for index in DeviceData.__table__.indexes:
+            index.create(db.engine, checkfirst=True)
+
+        inspector = inspect(db.engine)
+        missing = []
+        for table in db.metadata.sorted_tables:
+            existing = {column['name'] for column in inspector.get_columns(table.name)}
+            missing += [f'{table.name}.{column.name}' for column in table.columns if column.name not in existing]
+    if missing:
+        app.logger.warning('Columns missing from the database, they have to be added by hand: %s', ', '.join(missing))
+    return missing
+
 def create_database(app):
     if not path.exists('website/' + DB_NAME):
         db.create_all(app=app)
@@ -0,0 +1,133 @@
+# admin_views.py
+# Flask-Admin views for the large tables. The stock ModelView runs an exact COUNT(*) and OFFSET pagination on every
+# list page, which gets slower as device_data grows. These views show an estimated row count instead and page with a
+# keyset ("after" cursor) on an indexed, unique ordering, so every page costs about the same as the first one.
+
+import base64
+import json
+import time
+from datetime import datetime
+
+from flask import g, request
+from flask_admin.contrib.sqla import ModelView
+from flask_admin.contrib.sqla.filters import (BaseSQLAFilter, DateTimeBetweenFilter, DateTimeGreaterFilter,
+                                              DateTimeSmallerFilter, IntEqualFilter)
+from sqlalchemy import DateTime, select, text, tuple_
+
+from . import db
+from .models import Device, DeviceData
+
+COUNT_CACHE_SECONDS = 60 # exact counts are cached this long on databases without table statistics
+_exact_counts = {} # table name -> (expires_at, count)
+
+
+def estimated_row_count(table):
+    # Postgres keeps an estimate of every table's size in pg_class (updated by VACUUM / ANALYZE), reading it is free.
+    # It is -1 before the table was analyzed for the first time, then an exact count is used like on SQLite.
+    if db.engine.dialect.name == 'postgresql':
+        estimate = db.session.execute(text('SELECT reltuples::bigint FROM pg_class WHERE oid = CAST(:table AS regclass)'),
+                                      {'table': table.name}).scalar()
+        if estimate is not None and estimate >= 0:
+            return estimate
+    expires_at, count = _exact_counts.get(table.name, (0, None))
+    if time.monotonic() >= expires_at:
+        count = db.session.execute(select(db.func.count()).select_from(table)).scalar()
+        _exact_counts[table.name] = (time.monotonic() + COUNT_CACHE_SECONDS, count)
+    return count
+
+
+class DeviceSerialFilter(BaseSQLAFilter):
+    # Filters device_data by the serial number of its device, resolved to the device id with the unique serial index
+    def apply(self, query, value, alias=None):
+        device_id = select(Device.id).where(Device.serial_number == value).scalar_subquery()
+        return query.filter(self.get_column(alias) == device_id)
+
+    def operation(self):
+        return 'serial number is'
+
+
+class KeysetModelView(ModelView):
+    # keyset_columns must be unique together and covered by an index, the list is always ordered by them
+    keyset_columns = ('id',)
+    list_template = 'admin/keyset_list.html'
+    simple_list_pager = True # no COUNT(*) of the filtered rows
+    column_sortable_list = ()
+    column_display_pk = True
+    page_size = 50
+
+    def _get_list_extra_args(self):
+        view_args = super()._get_list_extra_args()
+        # The cursor belongs to one page of one filter set, keep it out of the urls the list page generates
+        view_args.extra_args.pop('after', None)
+        view_args.page = 0
+        return view_args
+
+    def _encode_key(self, row):
+        values = [getattr(row, name) for name in self.keyset_columns]
+        values = [value.isoformat() if isinstance(value, datetime) else value for value in values]
+        return base64.urlsafe_b64encode(json.dumps(values).encode()).decode()
+
+    def _decode_key(self, cursor):
+        try:
+            values = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+            columns = [getattr(self.model, name) for name in self.keyset_columns]
+            if len(values) != len(columns):
+                return None
+            return tuple(datetime.fromisoformat(value) if isinstance(column.type, DateTime) else value
+                         for column, value in zip(columns, values))
+        except (ValueError, TypeError, UnicodeError):
+            return None # a bad cursor shows the first page
+
+    def get_list(self, page, sort_column, sort_desc, search, filters, execute=True, page_size=None):
+        # Let ModelView apply search and filters, then page with the keyset instead of OFFSET
+        count, query = super().get_list(None, None, False, search, filters, execute=False, page_size=0)
+        columns = [getattr(self.model, name) for name in self.keyset_columns]
+        after = self._decode_key(request.args.get('after', ''))
+        if after is not None:
+            query = query.filter(tuple_(*columns) > after)
+        page_size = page_size or self.page_size
+        query = query.order_by(*columns).limit(page_size)
+        if not execute:
+            return count, query
+
+        rows = query.all()
+        g.admin_next_cursor = self._encode_key(rows[-1]) if len(rows) == page_size else None
+        return count, rows
+
+    def render(self, template, **kwargs):
+        if template == self.list_template:
+            list_url = kwargs['return_url']
+            next_cursor = g.pop('admin_next_cursor', None)
+            kwargs['next_page_url'] = f"{list_url}{'&' if '?' in list_url else '?'}after={next_cursor}" if next_cursor else None
+            kwargs['first_page_url'] = list_url if request.args.get('after') else None
+            # The estimate is of the whole table, it means nothing once the rows are filtered
+            if not kwargs.get('active_filters') and not kwargs.get('search'):
+                kwargs['count'] = f'~{estimated_row_count(self.model.__table__):,}'
+        return super().render(template, **kwargs)
+
+
+class DeviceView(KeysetModelView):
+    column_list = ('id', 'name', 'type', 'serial_number', 'owner.email')
+    column_labels = {'owner.email': 'Owner'}
+    column_searchable_list = ('serial_number', 'name')
+    column_filters = ('serial_number', 'name', 'type', 'owner.email')
+
+
+class DeviceDataView(KeysetModelView):
+    # Rollups are kept up to date by the ingest path, rows changed here would leave them stale, so the view is read only
+    can_create = False
+    can_edit = False
+    can_delete = False
+
+    # Matches ix_device_data_device_id_timestamp, the id breaks ties between samples with the same timestamp
+    keyset_columns = ('device_id', 'timestamp', 'id')
+    column_list = ('id', 'device_id', 'device.serial_number', 'timestamp', 'value1', 'value2')
+    column_labels = {'device_id': 'Device ID', 'device.serial_number': 'Serial number', 'timestamp': 'Timestamp (UTC)'}
+    # Only filters that can use the (device_id, timestamp) index
+    column_filters = (
+        IntEqualFilter(DeviceData.device_id, 'Device ID'),
+        DeviceSerialFilter(DeviceData.device_id, 'Device'),
+        DateTimeGreaterFilter(DeviceData.timestamp, 'Timestamp (UTC)'),
+        DateTimeSmallerFilter(DeviceData.timestamp, 'Timestamp (UTC)'),
+        DateTimeBetweenFilter(DeviceData.timestamp, 'Timestamp (UTC)'),
+    )
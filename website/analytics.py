@@ -0,0 +1,135 @@
+# analytics.py
+# Rehab progress of a device, computed from its whole history (both tiers, see series.load_device_series) in one pass
+# over NumPy arrays. The samples are split into sessions wherever the device was silent for longer than
+# ANALYTICS_SESSION_GAP_SECONDS, then every session gets the percentiles and range of motion (p95 - p5) of both
+# values, a rolling mean over the last sessions and a least-squares trend in units per week.
+# Results are cached per device together with the id of its newest sample, so they are only recomputed after new data.
+
+import numpy as np
+
+from .cache import analytics_cache
+from .series import load_device_series, last_data_id
+
+PERCENTILES = (5, 50, 95)
+MS_PER_WEEK = 7 * 24 * 3600 * 1000
+
+
+def split_sessions(t_ms, gap_ms):
+    # Indices of the first sample of every session, t_ms must be sorted
+    if len(t_ms) == 0:
+        return np.empty(0, dtype=np.int64)
+    return np.concatenate(([0], np.flatnonzero(np.diff(t_ms) > gap_ms) + 1))
+
+
+def session_percentiles(values, session_ids, session_count, percentiles=PERCENTILES):
+    # Linearly interpolated percentiles (like np.percentile) of the values of every session, shape
+    # (len(percentiles), session_count). Missing values (NaN) are left out, sessions without any value get NaN.
+    present = ~np.isnan(values)
+    values, session_ids = values[present], session_ids[present]
+    result = np.full((len(percentiles), session_count), np.nan)
+    if len(values) == 0:
+        return result
+
+    # Sorted by session, then by value, so the samples of session i sit in [offsets[i], offsets[i] + counts[i])
+    order = np.lexsort((values, session_ids))
+    values = values[order]
+    counts = np.bincount(session_ids, minlength=session_count)
+    offsets = np.concatenate(([0], np.cumsum(counts)[:-1]))
+    filled = counts > 0
+    for row, q in enumerate(percentiles):
+        position = offsets[filled] + (counts[filled] - 1) * (q / 100)
+        low = np.floor(position).astype(np.int64)
+        high = np.ceil(position).astype(np.int64)
+        result[row, filled] = values[low] + (values[high] - values[low]) * (position - low)
+    return result
+
+
+def rolling_mean(values, window):
+    # Mean of every value and the window - 1 before it, missing values (NaN) are left out of each mean
+    present = ~np.isnan(values)
+    sums = np.concatenate(([0.0], np.cumsum(np.where(present, values, 0.0))))
+    counts = np.concatenate(([0], np.cumsum(present)))
+    end = np.arange(1, len(values) + 1)
+    start = np.maximum(end - window, 0)
+    count = counts[end] - counts[start]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(count > 0, (sums[end] - sums[start]) / count, np.nan)
+
+
+def trend_slope(x, y):
+    # Least-squares slope of y over x, None with fewer than two points or no spread in x
+    present = ~np.isnan(y)
+    x, y = x[present].astype(np.float64), y[present]
+    if len(x) < 2:
+        return None
+    x = x - x.mean()
+    spread = np.dot(x, x)
+    if spread == 0:
+        return None
+    return float(np.dot(x, y - y.mean()) / spread)
+
+
+def _json_list(values, decimals=3):
+    return [None if value != value else value for value in np.round(values, decimals).tolist()]
+
+
+def _value_analytics(values, session_ids, session_count, session_t_ms, rolling_window):
+    low, median, high = session_percentiles(values, session_ids, session_count)
+    rom = high - low
+    sums = np.bincount(session_ids, weights=np.where(np.isnan(values), 0.0, values), minlength=session_count)
+    counts = np.bincount(session_ids, weights=~np.isnan(values), minlength=session_count)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        means = sums / counts
+    rom_slope = trend_slope(session_t_ms, rom)
+    median_slope = trend_slope(session_t_ms, median)
+    return {
+        'p5': _json_list(low),
+        'median': _json_list(median),
+        'p95': _json_list(high),
+        'rom': _json_list(rom),
+        'mean': _json_list(means),
+        'rom_rolling_mean': _json_list(rolling_mean(rom, rolling_window)),
+        'rom_trend_per_week': None if rom_slope is None else round(rom_slope * MS_PER_WEEK, 4),
+        'median_trend_per_week': None if median_slope is None else round(median_slope * MS_PER_WEEK, 4),
+    }
+
+
+def compute_analytics(t_ms, values1, values2, session_gap_seconds, rolling_window):
+    # Session statistics of a sorted series, as a JSON ready dict with one list entry per session
+    starts = split_sessions(t_ms, session_gap_seconds * 1000)
+    session_count = len(starts)
+    session_ids = np.zeros(len(t_ms), dtype=np.int64)
+    if session_count:
+        session_ids[starts[1:]] = 1
+        session_ids = np.cumsum(session_ids)
+    ends = np.append(starts[1:], len(t_ms)) - 1
+    session_t_ms = t_ms[starts]
+
+    return {
+        'sample_count': int(len(t_ms)),
+        'session_gap_seconds': session_gap_seconds,
+        'rolling_window': rolling_window,
+        'sessions': {
+            'start': session_t_ms.tolist(),
+            'end': t_ms[ends].tolist() if session_count else [],
+            'samples': np.diff(np.append(starts, len(t_ms))).tolist(),
+        },
+        'value1': _value_analytics(values1, session_ids, session_count, session_t_ms, rolling_window),
+        'value2': _value_analytics(values2, session_ids, session_count, session_t_ms, rolling_window),
+    }
+
+
+def device_analytics(device_id, session_gap_seconds, rolling_window):
+    # Cached analytics of a device. The watermark (id of its newest sample) costs one indexed query, the series is
+    # only loaded when it moved. The caller checks that the device belongs to the current user.
+    watermark = last_data_id(device_id)
+    key = (device_id, session_gap_seconds, rolling_window)
+    cached = analytics_cache.get(key)
+    if cached is not None and cached[0] == watermark:
+        return cached[1]
+
+    result = compute_analytics(*load_device_series(device_id), session_gap_seconds, rolling_window)
+    result['device_id'] = device_id
+    result['watermark'] = watermark
+    analytics_cache.set(key, (watermark, result))
+    return result
@@ -0,0 +1,151 @@
+# archive.py
+# Cold tier of the telemetry. Once a calendar month (UTC) is older than ARCHIVE_AFTER_DAYS, the samples of each device
+# in that month are moved out of DeviceData into one DeviceDataArchive row holding a compressed columnar chunk, so the
+# hot table (and its index) only grows with the recent months. series.py reads both tiers, and the rollups keep
+# covering the archived months. Archived timestamps are kept to the millisecond, like everywhere the charts read them.
+
+from datetime import datetime, timedelta, timezone
+import struct
+import zlib
+
+import numpy as np
+from sqlalchemy import select, delete, func
+
+from . import db
+from .models import Device, DeviceData, DeviceDataArchive
+
+CHUNK_MAGIC = b'LMA1'
+COMPRESSION_LEVEL = 6
+
+
+def _shuffle(values):
+    # Byte transposition: the sign and exponent bytes of neighbouring samples end up next to each other, which zlib
+    # compresses much better than interleaved float64s
+    return np.ascontiguousarray(values, dtype='<f8').view(np.uint8).reshape(-1, 8).T.tobytes()
+
+
+def _unshuffle(data, count):
+    return np.frombuffer(data, dtype=np.uint8).reshape(8, count).T.copy().view('<f8').ravel()
+
+
+def encode_chunk(t_ms, values1, values2):
+    # b'LMA1' + uint32 count, then zlib of the delta-encoded int64 timestamps (epoch ms, the first one relative to 0)
+    # followed by the shuffled float64 value1 and value2 columns. t_ms must be sorted, missing values are NaN.
+    t_ms = np.asarray(t_ms, dtype=np.int64)
+    deltas = np.diff(t_ms, prepend=np.int64(0))
+    body = b''.join((deltas.astype('<i8').tobytes(), _shuffle(values1), _shuffle(values2)))
+    return CHUNK_MAGIC + struct.pack('<I', len(t_ms)) + zlib.compress(body, COMPRESSION_LEVEL)
+
+
+def decode_chunk(data):
+    # Returns (t_ms, value1, value2) NumPy arrays
+    if data[:4] != CHUNK_MAGIC:
+        raise ValueError('Not an archive chunk')
+    count, = struct.unpack('<I', data[4:8])
+    body = memoryview(zlib.decompress(data[8:]))
+    size = 8 * count
+    t_ms = np.cumsum(np.frombuffer(body[:size], dtype='<i8'))
+    return t_ms, _unshuffle(body[size:2 * size], count), _unshuffle(body[2 * size:], count)
+
+
+def _as_utc(timestamp):
+    # SQLite returns naive UTC datetimes
+    if timestamp.tzinfo is None:
+        return timestamp.replace(tzinfo=timezone.utc)
+    return timestamp.astimezone(timezone.utc)
+
+
+def _to_ms(timestamp):
+    return int(_as_utc(timestamp).timestamp() * 1000)
+
+
+def month_start(timestamp):
+    return _as_utc(timestamp).replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+
+def next_month(start):
+    return start.replace(year=start.year + 1, month=1) if start.month == 12 else start.replace(month=start.month + 1)
+
+
+def iter_archived_months(device_id, start=None, end=None):
+    # Yields (month_start, month_end, t_ms, value1, value2) for the archived months of a device overlapping
+    # [start, end), oldest first, with the arrays limited to the window. One chunk is decoded at a time.
+    query = select(DeviceDataArchive.month_start).where(DeviceDataArchive.device_id == device_id)
+    if start is not None:
+        query = query.where(DeviceDataArchive.last_timestamp >= start)
+    if end is not None:
+        query = query.where(DeviceDataArchive.first_timestamp < end)
+    months = db.session.execute(query.order_by(DeviceDataArchive.month_start)).scalars().all()
+
+    for month in months:
+        data = db.session.execute(select(DeviceDataArchive.data).where(DeviceDataArchive.device_id == device_id,
+                                                                       DeviceDataArchive.month_start == month)).scalar()
+        t_ms, values1, values2 = decode_chunk(data)
+        in_window = np.ones(len(t_ms), dtype=bool)
+        if start is not None:
+            in_window &= t_ms >= _to_ms(start)
+        if end is not None:
+            in_window &= t_ms < _to_ms(end)
+        month = _as_utc(month)
+        yield month, next_month(month), t_ms[in_window], values1[in_window], values2[in_window]
+
+
+def load_archived_series(device_id, start=None, end=None):
+    # The archived samples of a device in [start, end) as (t_ms, value1, value2), or None if there are none
+    months = list(iter_archived_months(device_id, start, end))
+    if not months:
+        return None
+    return tuple(np.concatenate([month[i] for month in months]) for i in (2, 3, 4))
+
+
+def archive_device_data(older_than_days, device_id=None, progress=print):
+    # Moves every month that started before the month of (now - older_than_days) from DeviceData into the archive,
+    # one transaction per device and month. The rows are deleted with RETURNING, so exactly the deleted samples are
+    # archived. Samples that arrive later for an archived month are merged into its chunk by the next run.
+    from .series import to_epoch_ms
+    table = DeviceData.__table__
+    cutoff = month_start(datetime.now(timezone.utc) - timedelta(days=older_than_days))
+    if device_id is not None:
+        device_ids = [device_id]
+    else:
+        device_ids = db.session.execute(select(Device.id).order_by(Device.id)).scalars().all()
+
+    total = 0
+    for current_device in device_ids:
+        while True:
+            oldest = db.session.execute(select(func.min(DeviceData.timestamp))
+                                        .where(DeviceData.device_id == current_device, DeviceData.timestamp < cutoff)).scalar()
+            if oldest is None:
+                break
+            month = month_start(oldest)
+            month_end = next_month(month)
+
+            rows = db.session.execute(delete(table)
+                                      .where(table.c.device_id == current_device, table.c.timestamp >= month, table.c.timestamp < month_end)
+                                      .returning(table.c.timestamp, table.c.value1, table.c.value2)).all()
+            timestamps, values1, values2 = zip(*rows)
+            t_ms = to_epoch_ms(list(timestamps))
+            values1 = np.array(values1, dtype=np.float64)
+            values2 = np.array(values2, dtype=np.float64)
+
+            chunk = db.session.get(DeviceDataArchive, (current_device, month))
+            if chunk is not None:
+                archived_t_ms, archived_values1, archived_values2 = decode_chunk(chunk.data)
+                t_ms = np.concatenate((archived_t_ms, t_ms))
+                values1 = np.concatenate((archived_values1, values1))
+                values2 = np.concatenate((archived_values2, values2))
+            else:
+                chunk = DeviceDataArchive(device_id=current_device, month_start=month)
+                db.session.add(chunk)
+
+            order = np.argsort(t_ms, kind='stable')
+            t_ms, values1, values2 = t_ms[order], values1[order], values2[order]
+            chunk.count = len(t_ms)
+            chunk.first_timestamp = datetime.fromtimestamp(t_ms[0] / 1000, tz=timezone.utc)
+            chunk.last_timestamp = datetime.fromtimestamp(t_ms[-1] / 1000, tz=timezone.utc)
+            chunk.data = encode_chunk(t_ms, values1, values2)
+            db.session.commit()
+
+            total += len(rows)
+            progress(f'Archived {len(rows)} samples of Device {current_device} for {month:%Y-%m} ({len(chunk.data)} bytes)')
+    return total
@@ -0,0 +1,208 @@
+# assets.py
+# Static asset pipeline. "python -m website.assets" (or ASSETS_BUILD_ON_STARTUP=1) writes into static/build:
+#   - resized WebP and JPEG/PNG variants of every image in static/images, for srcset (needs Pillow)
+#   - copies of the CSS and JS files with a content hash in the name, plus .gz and .br (needs brotli) versions
+#   - manifest.json, mapping the original file names to the generated ones
+# File names contain a hash of their source, so build/ files are served with a one year immutable Cache-Control and
+# a changed source gets a new url. The template helpers fall back to the original files when nothing was built.
+
+import gzip
+import hashlib
+import json
+import os
+
+from flask import current_app, request, send_from_directory, url_for
+from markupsafe import Markup, escape
+
+try:
+    from PIL import Image
+except ImportError:  # Pillow is optional, without it the original images are served
+    Image = None
+
+try:
+    import brotli
+except ImportError:  # brotli is optional, only the .gz copies are made without it
+    brotli = None
+
+BUILD_DIR = 'build'
+MANIFEST = 'manifest.json'
+IMAGE_WIDTHS = (160, 480, 960, 1600) # widths of the variants, smaller than the original only, the largest one caps it
+IMAGE_EXTENSIONS = {'.jpg': 'JPEG', '.jpeg': 'JPEG', '.png': 'PNG'}
+TEXT_EXTENSIONS = ('.css', '.js')
+CACHE_SECONDS = 365 * 24 * 3600
+
+
+def _content_hash(path):
+    with open(path, 'rb') as source:
+        return hashlib.sha256(source.read()).hexdigest()[:12]
+
+
+def _write_atomic(path, data):
+    # Several workers may build at startup at the same time, a half written file is never visible
+    temporary = f'{path}.{os.getpid()}.tmp'
+    with open(temporary, 'wb') as output:
+        output.write(data)
+    os.replace(temporary, path)
+
+
+def _build_text_asset(static_folder, filename, build_folder):
+    stem, extension = os.path.splitext(filename)
+    built = f'{stem}.{_content_hash(os.path.join(static_folder, filename))}{extension}'
+    path = os.path.join(build_folder, built)
+    if not os.path.exists(path):
+        with open(os.path.join(static_folder, filename), 'rb') as source:
+            data = source.read()
+        _write_atomic(path + '.gz', gzip.compress(data, compresslevel=9, mtime=0))
+        if brotli is not None:
+            _write_atomic(path + '.br', brotli.compress(data, quality=11))
+        _write_atomic(path, data)
+    return f'{BUILD_DIR}/{built}'
+
+
+def _build_image(static_folder, filename, build_folder):
+    # Returns the manifest entry of one image: its size and the (width, path) variants per format
+    stem, extension = os.path.splitext(os.path.basename(filename))
+    fallback_format = IMAGE_EXTENSIONS[extension.lower()]
+    digest = _content_hash(os.path.join(static_folder, filename))
+    os.makedirs(os.path.join(build_folder, 'images'), exist_ok=True)
+
+    with Image.open(os.path.join(static_folder, filename)) as original:
+        width, height = original.size
+        widths = sorted({min(w, width) for w in IMAGE_WIDTHS})
+        variants = {'webp': [], 'fallback': []}
+        for variant_width in widths:
+            for kind, image_format, variant_extension in (('webp', 'WEBP', '.webp'), ('fallback', fallback_format, extension.lower())):
+                built = f'images/{stem}-{variant_width}w.{digest}{variant_extension}'
+                path = os.path.join(build_folder, built)
+                if not os.path.exists(path):
+                    resized = original.resize((variant_width, max(round(height * variant_width / width), 1)), Image.LANCZOS)
+                    if image_format == 'JPEG' and resized.mode not in ('RGB', 'L'):
+                        resized = resized.convert('RGB')
+                    temporary = f'{path}.{os.getpid()}.tmp'
+                    resized.save(temporary, format=image_format, quality=80, optimize=True)
+                    os.replace(temporary, path)
+                variants[kind].append((variant_width, f'{BUILD_DIR}/{built}'))
+    return {'width': width, 'height': height, **variants}
+
+
+def build_assets(static_folder, progress=print):
+    build_folder = os.path.join(static_folder, BUILD_DIR)
+    os.makedirs(build_folder, exist_ok=True)
+    manifest = {'files': {}, 'images': {}}
+
+    for filename in sorted(os.listdir(static_folder)):
+        if filename.endswith(TEXT_EXTENSIONS):
+            manifest['files'][filename] = _build_text_asset(static_folder, filename, build_folder)
+
+    if Image is None:
+        progress('Pillow is not installed, skipping the image variants')
+    else:
+        images_folder = os.path.join(static_folder, 'images')
+        for filename in sorted(os.listdir(images_folder)):
+            if os.path.splitext(filename)[1].lower() in IMAGE_EXTENSIONS:
+                manifest['images'][f'images/{filename}'] = _build_image(static_folder, f'images/{filename}', build_folder)
+                progress(f'Built variants of images/{filename}')
+
+    _write_atomic(os.path.join(build_folder, MANIFEST), json.dumps(manifest, indent=2).encode())
+    progress(f"Built {len(manifest['files'])} files and {len(manifest['images'])} images into {build_folder}")
+    return manifest
+
+
+def load_manifest(static_folder):
+    try:
+        with open(os.path.join(static_folder, BUILD_DIR, MANIFEST)) as manifest_file:
+            return json.load(manifest_file)
+    except FileNotFoundError:
+        return {'files': {}, 'images': {}}
+
+
+# Template helpers, registered as Jinja globals by init_app
+
+def asset_url(filename):
+    # Fingerprinted url of a CSS/JS file in static/
+    manifest = current_app.extensions['assets']
+    return url_for('static', filename=manifest['files'].get(filename, filename))
+
+
+def image_url(filename, width=None, webp=False):
+    # Url of the variant at least width pixels wide (the largest one by default), or of the original image
+    entry = current_app.extensions['assets']['images'].get(filename)
+    if entry is None:
+        return url_for('static', filename=filename)
+    variants = entry['webp' if webp else 'fallback']
+    path = next((path for variant_width, path in variants if width and variant_width >= width), variants[-1][1])
+    return url_for('static', filename=path)
+
+
+def _srcset(variants):
+    return ', '.join(f"{url_for('static', filename=path)} {width}w" for width, path in variants)
+
+
+def responsive_image(filename, alt, sizes='100vw', **attributes):
+    # <picture> with WebP and JPEG/PNG srcsets, lazy loaded. Extra keyword arguments become <img> attributes
+    # (class_ for class).
+    attributes = {name.rstrip('_'): value for name, value in attributes.items()}
+    attributes.setdefault('loading', 'lazy')
+    extra = ''.join(f' {name}="{escape(value)}"' for name, value in attributes.items())
+    entry = current_app.extensions['assets']['images'].get(filename)
+    if entry is None:
+        return Markup(f'<img src="{escape(url_for("static", filename=filename))}" alt="{escape(alt)}"{extra}>')
+    # The intrinsic size lets the browser reserve the space before the image loads, unless the caller sets one
+    size = '' if 'width' in attributes or 'height' in attributes else f'width="{entry["width"]}" height="{entry["height"]}"'
+    return Markup(
+        f'<picture>'
+        f'<source type="image/webp" srcset="{escape(_srcset(entry["webp"]))}" sizes="{escape(sizes)}">'
+        f'<img src="{escape(image_url(filename))}" srcset="{escape(_srcset(entry["fallback"]))}" sizes="{escape(sizes)}" '
+        f'{size} alt="{escape(alt)}"{extra}>'
+        f'</picture>'
+    )
+
+
+def background_image(filename, width=None):
+    # CSS declarations for a background image, WebP for the browsers that understand image-set() with types
+    if filename not in current_app.extensions['assets']['images']:
+        return Markup(f"background-image: url('{escape(image_url(filename))}');")
+    fallback_type = 'image/png' if filename.lower().endswith('.png') else 'image/jpeg'
+    return Markup(
+        f"background-image: url('{escape(image_url(filename, width))}'); "
+        f"background-image: image-set(url('{escape(image_url(filename, width, webp=True))}') type('image/webp'), "
+        f"url('{escape(image_url(filename, width))}') type('{fallback_type}'));"
+    )
+
+
+def _static_view(original_view, static_folder):
+    # Wraps Flask's static view: build/ files are immutable, and the CSS/JS ones are sent precompressed when possible
+    def static(filename):
+        if not filename.startswith(BUILD_DIR + '/'):
+            return original_view(filename=filename)
+
+        accepted = request.accept_encodings
+        for encoding, suffix in (('br', '.br'), ('gzip', '.gz')):
+            if accepted[encoding] and os.path.exists(os.path.join(static_folder, filename + suffix)):
+                response = send_from_directory(static_folder, filename + suffix, max_age=CACHE_SECONDS)
+                response.mimetype = 'text/css' if filename.endswith('.css') else 'text/javascript'
+                response.content_encoding = encoding
+                break
+        else:
+            response = original_view(filename=filename)
+        if filename.endswith(TEXT_EXTENSIONS):
+            response.vary.add('Accept-Encoding')
+        response.cache_control.no_cache = None
+        response.cache_control.public = True
+        response.cache_control.max_age = CACHE_SECONDS
+        response.cache_control.immutable = True
+        return response
+    return static
+
+
+def init_app(app):
+    if app.config['ASSETS_BUILD_ON_STARTUP']:
+        build_assets(app.static_folder, progress=app.logger.info)
+    app.extensions['assets'] = load_manifest(app.static_folder)
+    app.view_functions['static'] = _static_view(app.view_functions['static'], app.static_folder)
+    for helper in (asset_url, image_url, responsive_image, background_image):
+        app.add_template_global(helper)
+
+
+if __name__ == '__main__':
+    build_assets(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static'))
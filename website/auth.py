@@ -2,6 +2,8 @@ from flask import Blueprint, render_template, request, flash, redirect, url_for,
 from .models import User, Device
 from werkzeug.security import generate_password_hash, check_password_hash
 from . import db   ##means from __init__.py import db
+from sqlalchemy.exc import IntegrityError
+from .db_utils import invalidate_device, list_user_devices, invalidate_user_devices
 from flask_login import login_user, login_required, logout_user, current_user
 import json
 from flask import jsonify
@@ -79,28 +81,30 @@ def register_device():
         type = data.get('type')
         serial_number = data.get('serial_number')
 
-        # Check if device already exists
-        device = Device.query.filter_by(serial_number=serial_number).first()
-        if device:
+        # Check if device already exists. Asks the database, not the device cache, which can still hold a serial number
+        # another worker freed. The unique constraint catches two registrations racing each other.
+        if db.session.query(Device.id).filter_by(serial_number=serial_number).first():
             print('Device with this serial number already exists.')
             return jsonify({'error': 'Device with this serial number already exists.'}), 400
-        else:
-            print('Adding device:', name, type, serial_number)
-            new_device = Device(name=name, type=type, serial_number=serial_number, user_id=current_user.id)
-            db.session.add(new_device)
+        print('Adding device:', name, type, serial_number)
+        new_device = Device(name=name, type=type, serial_number=serial_number, user_id=current_user.id)
+        db.session.add(new_device)
+        try:
             db.session.commit()
-            return jsonify({'success': 'Device registered successfully!'})
+        except IntegrityError:
+            db.session.rollback()
+            return jsonify({'error': 'Device with this serial number already exists.'}), 400
+        invalidate_user_devices(current_user.id)
+        return jsonify({'success': 'Device registered successfully!'})
 
     # This part is unnecessary for POST request, should be handled differently
-    devices = Device.query.filter_by(user_id=current_user.id).all()
+    devices = list_user_devices(current_user.id)
     return render_template("devices.html", user=current_user, first_name=current_user.first_name, devices=devices, csrf_token=generate_csrf())
 
 @auth.route('/get-devices')
 @login_required
 def get_devices():
-    devices = Device.query.filter_by(user_id=current_user.id).all()
-    devices_list = [{'name': device.name, 'type': device.type, 'serial_number': device.serial_number, 'id': device.id} for device in devices]
-    return jsonify(devices_list)
+    return jsonify(list_user_devices(current_user.id))
 
 
 @auth.route('/delete-device', methods=['POST'])
@@ -111,8 +115,11 @@ def delete_device():
     device = Device.query.get(device_id)
 
     if device and device.user_id == current_user.id:
+        serial_number = device.serial_number
         db.session.delete(device)
         db.session.commit()
+        invalidate_device(serial_number)
+        invalidate_user_devices(current_user.id)
         return jsonify({'success': 'Device deleted'})
     else:
         return jsonify({'error': 'Device not found or unauthorized'}), 404
@@ -124,10 +131,13 @@ def edit_device():
     data = request.get_json()
     device = Device.query.get(data['id'])
     if device and device.user_id == current_user.id:
+        old_serial_number = device.serial_number
         device.name = data['name']
         device.type = data['type']
         device.serial_number = data['serial_number']
         db.session.commit()
+        invalidate_device(old_serial_number, device.serial_number)
+        invalidate_user_devices(current_user.id)
         return jsonify({'success': True})
     else:
         return jsonify({'error': 'Unauthorized or invalid data'}), 400
@@ -0,0 +1,241 @@
+# bulk.py
+# Bulk import and dump of DeviceData as CSV or NDJSON files (optionally .gz), for backfilling historical device logs
+# and moving data between databases. Both stream the file in chunks of chunk_size samples. Every imported chunk is one
+# transaction: COPY on Postgres (psycopg2), a single executemany elsewhere, together with the rollup update of its
+# samples. Run them through the db_utils CLI (--import-device-data / --dump-device-data).
+#
+# Rows are serial_number, timestamp, value1, value2. Timestamps are ISO 8601 (naive ones are UTC) or epoch seconds,
+# empty values are NULL. The dump writes the same columns, so a dump can be imported into another database.
+
+import csv
+import gzip
+import io
+import json
+import sys
+import time
+from contextlib import contextmanager
+from datetime import timezone
+
+from sqlalchemy import insert, select
+
+from . import db
+from .models import Device, DeviceData
+from .db_utils import resolve_devices, parse_timestamp
+from .rollups import update_rollups
+from .series import iter_device_data_chunks
+from .chart_cache import forget_watermarks
+
+COLUMNS = ('serial_number', 'timestamp', 'value1', 'value2')
+FORMATS = ('csv', 'ndjson')
+MAX_REPORTED_ERRORS = 20 # rejected lines printed by an import, the others are only counted
+
+
+def detect_format(path):
+    # From the file name, e.g. data.ndjson.gz -> 'ndjson'; anything else is CSV
+    name = path[:-3] if path.endswith('.gz') else path
+    return 'ndjson' if name.endswith(('.ndjson', '.jsonl')) else 'csv'
+
+
+@contextmanager
+def _open(path, mode):
+    # '-' is stdin / stdout, .gz files are (de)compressed on the fly
+    if path == '-':
+        yield sys.stdin if 'r' in mode else sys.stdout
+    elif path.endswith('.gz'):
+        with gzip.open(path, mode + 't', encoding='utf-8', newline='') as file:
+            yield file
+    else:
+        with open(path, mode, encoding='utf-8', newline='') as file:
+            yield file
+
+
+def _iter_records(file, file_format):
+    # Yields (line number, (serial_number, timestamp, value1, value2), None), or (line number, None, error) for lines
+    # that can't be read
+    if file_format == 'ndjson':
+        for line_number, line in enumerate(file, 1):
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+                yield line_number, tuple(record.get(column) for column in COLUMNS), None
+            except (ValueError, AttributeError) as e:
+                yield line_number, None, f'invalid JSON object: {e}'
+        return
+
+    reader = csv.reader(file)
+    header = next(reader, None)
+    if header is None:
+        return
+    try:
+        positions = [header.index(column) for column in COLUMNS]
+    except ValueError:
+        raise ValueError(f"The CSV header must contain the columns {', '.join(COLUMNS)}") from None
+    for line_number, row in enumerate(reader, 2):
+        try:
+            yield line_number, tuple(row[position] for position in positions), None
+        except IndexError:
+            yield line_number, None, 'missing columns'
+
+
+def _timestamp(value):
+    if isinstance(value, str):
+        try:
+            value = float(value)
+        except ValueError:
+            pass
+    if value is None or value == '':
+        raise ValueError('timestamp is missing')
+    return parse_timestamp(value)
+
+
+def _value(value):
+    if value is None or value == '':
+        return None
+    if isinstance(value, bool):
+        raise ValueError('values must be numbers')
+    value = float(value)
+    if value != value or value in (float('inf'), float('-inf')):
+        raise ValueError('values must be finite numbers')
+    return value
+
+
+def _to_rows(records, errors):
+    # Turns a chunk of records into DeviceData rows (dicts), the rejected lines are added to errors
+    devices = resolve_devices({record[0] for _, record, _ in records if record is not None and isinstance(record[0], str)})
+    rows = []
+    for line_number, record, error in records:
+        try:
+            if record is None:
+                raise ValueError(error)
+            serial_number, timestamp, value1, value2 = record
+            device = devices.get(serial_number) if isinstance(serial_number, str) else None
+            if device is None:
+                raise ValueError(f'unknown device {serial_number!r}')
+            rows.append({'device_id': device[0], 'timestamp': _timestamp(timestamp), 'value1': _value(value1), 'value2': _value(value2)})
+        except (ValueError, TypeError, OverflowError, OSError) as e:
+            if len(errors) < MAX_REPORTED_ERRORS:
+                errors.append((line_number, str(e)))
+    return rows
+
+
+def _copy_rows(rows):
+    # Postgres: COPY FROM STDIN in CSV format, much faster than an INSERT per row. Unquoted empty fields are NULL.
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerows((row['device_id'], row['timestamp'].isoformat(),
+                      '' if row['value1'] is None else repr(row['value1']),
+                      '' if row['value2'] is None else repr(row['value2'])) for row in rows)
+    buffer.seek(0)
+    cursor = db.session.connection().connection.cursor()
+    try:
+        cursor.copy_expert('COPY device_data (device_id, timestamp, value1, value2) FROM STDIN WITH (FORMAT csv)', buffer)
+    finally:
+        cursor.close()
+
+
+def _write_chunk(rows, use_copy):
+    if not rows:
+        return
+    try:
+        if use_copy:
+            _copy_rows(rows)
+        else:
+            db.session.execute(insert(DeviceData.__table__), rows)
+        update_rollups(rows)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    # COPY doesn't return the new ids, the cached chart payloads are revalidated against the database instead
+    forget_watermarks({row['device_id'] for row in rows})
+
+
+@contextmanager
+def _indexes_dropped(enabled, progress):
+    # Dropping the secondary indexes of device_data before a large import and building them once at the end is faster
+    # than updating them row by row. They are rebuilt even when the import fails.
+    indexes = list(DeviceData.__table__.indexes) if enabled else []
+    for index in indexes:
+        index.drop(db.engine, checkfirst=True)
+        progress(f'Dropped index {index.name}')
+    try:
+        yield
+    finally:
+        for index in indexes:
+            started = time.perf_counter()
+            index.create(db.engine, checkfirst=True)
+            progress(f'Rebuilt index {index.name} in {time.perf_counter() - started:.1f} s')
+
+
+def import_device_data(path, file_format=None, chunk_size=50000, drop_indexes=False, progress=print):
+    # Returns (imported, rejected). Chunks already committed stay imported if a later one fails.
+    file_format = file_format or detect_format(path)
+    use_copy = db.engine.dialect.name == 'postgresql' and db.engine.dialect.driver == 'psycopg2'
+    imported = 0
+    rejected = 0
+    errors = []
+    started = time.perf_counter()
+
+    with _open(path, 'r') as file, _indexes_dropped(drop_indexes, progress):
+        chunk = []
+        for record in _iter_records(file, file_format):
+            chunk.append(record)
+            if len(chunk) < chunk_size:
+                continue
+            rows = _to_rows(chunk, errors)
+            _write_chunk(rows, use_copy)
+            imported += len(rows)
+            rejected += len(chunk) - len(rows)
+            chunk = []
+            elapsed = time.perf_counter() - started
+            progress(f'Imported {imported} samples, {imported / elapsed:,.0f} samples/s')
+        if chunk:
+            rows = _to_rows(chunk, errors)
+            _write_chunk(rows, use_copy)
+            imported += len(rows)
+            rejected += len(chunk) - len(rows)
+
+    for line_number, error in errors:
+        progress(f'Line {line_number} rejected: {error}')
+    elapsed = time.perf_counter() - started
+    progress(f'Imported {imported} samples ({rejected} rejected) in {elapsed:.1f} s, {imported / max(elapsed, 1e-9):,.0f} samples/s')
+    return imported, rejected
+
+
+def _format_timestamp(timestamp):
+    # SQLite returns naive UTC timestamps and the archive aware ones
+    return (timestamp if timestamp.tzinfo else timestamp.replace(tzinfo=timezone.utc)).isoformat()
+
+
+def dump_device_data(path, file_format=None, serial_number=None, chunk_size=50000, progress=print):
+    # Writes the samples of every device (or of one), hot and archived, device by device in time order.
+    # Returns the number of samples written.
+    file_format = file_format or detect_format(path)
+    query = select(Device.id, Device.serial_number).order_by(Device.id)
+    if serial_number is not None:
+        query = query.where(Device.serial_number == serial_number)
+    devices = db.session.execute(query).all()
+    if serial_number is not None and not devices:
+        raise ValueError(f'Device with serial number {serial_number} not found.')
+
+    written = 0
+    started = time.perf_counter()
+    with _open(path, 'w') as file:
+        writer = csv.writer(file) if file_format == 'csv' else None
+        if writer is not None:
+            writer.writerow(COLUMNS)
+        for device_id, device_serial_number in devices:
+            for rows in iter_device_data_chunks(device_id, chunk_size=chunk_size):
+                if writer is not None:
+                    writer.writerows((device_serial_number, _format_timestamp(timestamp), value1, value2)
+                                     for timestamp, value1, value2 in rows)
+                else:
+                    file.writelines(json.dumps({'serial_number': device_serial_number, 'timestamp': _format_timestamp(timestamp),
+                                                'value1': value1, 'value2': value2}) + '\n'
+                                    for timestamp, value1, value2 in rows)
+                written += len(rows)
+                elapsed = time.perf_counter() - started
+                progress(f'Dumped {written} samples, {written / max(elapsed, 1e-9):,.0f} samples/s')
+    progress(f'Dumped {written} samples of {len(devices)} devices to {path} in {time.perf_counter() - started:.1f} s')
+    return written
@@ -0,0 +1,80 @@
+# cache.py
+# Small process-local caches. Every gunicorn worker has its own copy, so anything cached here must be invalidated
+# by the code that changes the underlying rows.
+
+from collections import OrderedDict
+import threading
+import time
+
+from .config import Config
+
+
+class LRUCache:
+    # Bounded mapping that evicts the least recently used entry once maxsize is reached. Safe to share between threads.
+    # With a ttl (seconds), entries also expire that long after they were set, which bounds how stale a value can get
+    # in the other workers, where the invalidation of the worker that made the change doesn't reach.
+
+    def __init__(self, maxsize, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key in self._data:
+                expires_at, value = self._data[key]
+                if expires_at is None or time.monotonic() < expires_at:
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._data[key]
+            self.misses += 1
+            return default
+
+    def set(self, key, value):
+        expires_at = time.monotonic() + self.ttl if self.ttl else None
+        with self._lock:
+            self._data[key] = (expires_at, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        with self._lock:
+            return {'size': len(self._data), 'maxsize': self.maxsize, 'ttl': self.ttl, 'hits': self.hits, 'misses': self.misses}
+
+    def __len__(self):
+        return len(self._data)
+
+
+# serial_number -> (device_id, user_id), used by the ingest path. The Device listeners only clear this worker's copy,
+# the ttl bounds how long the others keep a renamed, reassigned or deleted device.
+device_cache = LRUCache(maxsize=Config.DEVICE_CACHE_SIZE, ttl=Config.DEVICE_CACHE_TTL)
+
+# user_id -> UserSnapshot, returned by the login manager's user_loader instead of querying the user on every request
+user_cache = LRUCache(maxsize=Config.USER_CACHE_SIZE, ttl=Config.USER_CACHE_TTL)
+
+# user_id -> list of the user's devices as dicts (id, name, type, serial_number), for /get-devices and the ownership checks
+user_devices_cache = LRUCache(maxsize=Config.USER_CACHE_SIZE, ttl=Config.USER_CACHE_TTL)
+
+# (device_id, session gap, rolling window) -> (watermark, analytics), see analytics.device_analytics. Entries are checked
+# against the device's newest sample id on every read, so no invalidation is needed.
+analytics_cache = LRUCache(maxsize=Config.ANALYTICS_CACHE_SIZE)
+
+# (device_id, range, start, end, format, watermark) -> chart payload of /api/devices/<id>/series, see chart_cache.py.
+# The ttl bounds how long a payload of a relative window (?range=7d) is reused while its window moves on.
+chart_payload_cache = LRUCache(maxsize=Config.CHART_CACHE_SIZE, ttl=Config.CHART_CACHE_TTL)
+
+# device_id -> id of its newest sample, set by the ingest path of this worker and read again from the database after the ttl
+chart_watermark_cache = LRUCache(maxsize=Config.DEVICE_CACHE_SIZE, ttl=Config.CHART_CACHE_WATERMARK_TTL)
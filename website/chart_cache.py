@@ -0,0 +1,151 @@
+# chart_cache.py
+# Cache of the /api/devices/<id>/series payloads. An entry is keyed by the device, the requested window and format and
+# the device's watermark (the id of its newest sample), so it is reused until new samples arrive. Strong ETags derived
+# from the same key let the browser revalidate a chart it already has and get a 304 without the series being read again.
+#
+# The watermark of a device is set by the ingest path right after its commit (note_new_rows). Without a shared store,
+# the other workers only learn about it once their copy expires after CHART_CACHE_WATERMARK_TTL seconds and is read
+# again from the database. With CHART_CACHE_DIR, watermarks and payloads are files shared by every worker on the
+# machine, and a new sample is seen by all of them at once.
+
+import glob
+import hashlib
+import json
+import os
+import time
+
+from flask import current_app
+
+from .cache import chart_payload_cache, chart_watermark_cache
+from .series import last_data_id
+
+
+def _shared_dir(*parts):
+    directory = current_app.config['CHART_CACHE_DIR']
+    return os.path.join(directory, *parts) if directory else None
+
+
+def _write_atomic(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temporary = f'{path}.{os.getpid()}.tmp'
+    with open(temporary, 'wb') as output:
+        output.write(data)
+    os.replace(temporary, path)
+
+
+def _set_watermark(device_id, watermark):
+    chart_watermark_cache.set(device_id, watermark)
+    path = _shared_dir('watermarks', str(device_id))
+    if path:
+        _write_atomic(path, str(watermark).encode())
+
+
+def _known_watermark(device_id):
+    path = _shared_dir('watermarks', str(device_id))
+    if not path:
+        return chart_watermark_cache.get(device_id)
+    try:
+        with open(path) as watermark_file:
+            return int(watermark_file.read())
+    except (OSError, ValueError):
+        return None
+
+
+def current_watermark(device_id):
+    # The id of the device's newest sample, read from the shared store or this worker's cache when possible
+    watermark = _known_watermark(device_id)
+    if watermark is not None:
+        return watermark
+    watermark = last_data_id(device_id)
+    _set_watermark(device_id, watermark)
+    return watermark
+
+
+def note_new_rows(rows):
+    # Called by the ingest path after committing DeviceData rows (dicts with device_id and id)
+    newest = {}
+    for row in rows:
+        newest[row['device_id']] = max(newest.get(row['device_id'], 0), row['id'])
+    for device_id, watermark in newest.items():
+        # Another thread may have committed newer rows of the same device in the meantime
+        _set_watermark(device_id, max(watermark, _known_watermark(device_id) or 0))
+
+
+def forget_watermarks(device_ids):
+    # For writes that don't know the new ids (bulk COPY), the next read takes the watermark from the database
+    for device_id in device_ids:
+        chart_watermark_cache.invalidate(device_id)
+        path = _shared_dir('watermarks', str(device_id))
+        if path:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+
+def payload_key(device_id, args):
+    # The window exactly as requested (?range=, ?start=, ?end=) and the format. The resolution and the downsampling
+    # follow from them and the data, which the watermark pins.
+    window = tuple(args.get(name, '') for name in ('range', 'start', 'end', 'format'))
+    return (device_id, *window)
+
+
+def payload_version(key, watermark):
+    # A window with an explicit ?end= only changes with the watermark. The others end now and move with the clock, so
+    # their payload gets a new version every CHART_CACHE_TTL seconds too.
+    if key[3]:
+        return str(watermark)
+    ttl = current_app.config['CHART_CACHE_TTL']
+    return f'{watermark}.{int(time.time() // ttl) if ttl else 0}'
+
+
+def payload_etag(key, version):
+    # Derived from what the payload is built from instead of from the body, so a matching If-None-Match can be
+    # answered before the payload is loaded or built
+    settings = (current_app.config['CHART_MAX_POINTS'], current_app.config['CHART_DOWNSAMPLE'])
+    return hashlib.sha256(json.dumps([list(key), version, settings]).encode()).hexdigest()[:32]
+
+
+def _payload_path(key, version):
+    digest = hashlib.sha256(json.dumps(key[1:]).encode()).hexdigest()[:16]
+    return _shared_dir('payloads', str(key[0]), f'{digest}-{version}.bin')
+
+
+def get_payload(key, version):
+    # Returns the cached entry (dict with etag, mimetype, resolution and body) or None
+    entry = chart_payload_cache.get((*key, version))
+    if entry is not None:
+        return entry
+    path = _payload_path(key, version)
+    if not path:
+        return None
+    try:
+        with open(path, 'rb') as payload_file:
+            meta = json.loads(payload_file.readline())
+            entry = {**meta, 'body': payload_file.read()}
+    except (OSError, ValueError):
+        return None
+    chart_payload_cache.set((*key, version), entry)
+    return entry
+
+
+def store_payload(key, version, etag, body, mimetype, resolution):
+    entry = {
+        'etag': etag,
+        'mimetype': mimetype,
+        'resolution': resolution,
+        'body': body,
+    }
+    chart_payload_cache.set((*key, version), entry)
+    path = _payload_path(key, version)
+    if path:
+        meta = json.dumps({name: entry[name] for name in ('etag', 'mimetype', 'resolution')}).encode()
+        _write_atomic(path, meta + b'\n' + body)
+        # Older payloads of the same window can't be asked for anymore
+        for stale in glob.glob(path.rsplit('-', 1)[0] + '-*.bin'):
+            if stale != path:
+                try:
+                    os.remove(stale)
+                except FileNotFoundError:
+                    pass
+    return entry
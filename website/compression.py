@@ -0,0 +1,33 @@
+# compression.py
+# gzip/brotli compression of API responses, negotiated with the Accept-Encoding header
+
+import gzip
+
+from flask import request
+
+try:
+    import brotli
+except ImportError:  # brotli is optional, gzip is used when it isn't installed
+    brotli = None
+
+MIN_COMPRESS_SIZE = 1024 # smaller bodies aren't worth the CPU time
+
+
+def compress_response(response):
+    # Compresses a buffered response in place when the client accepts it
+    response.vary.add('Accept-Encoding')
+    if response.direct_passthrough or response.content_encoding or response.status_code != 200:
+        return response
+
+    body = response.get_data()
+    if len(body) < MIN_COMPRESS_SIZE:
+        return response
+
+    accepted = request.accept_encodings
+    if brotli is not None and accepted['br']:
+        response.set_data(brotli.compress(body, quality=5))
+        response.content_encoding = 'br'
+    elif accepted['gzip']:
+        response.set_data(gzip.compress(body, compresslevel=6))
+        response.content_encoding = 'gzip'
+    return response
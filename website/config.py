@@ -9,5 +9,84 @@ class Config:
 
     SECRET_KEY = os.environ.get('SECRET_KEY') or 'you-will-never-guess' # I am not sure why the app in __init__ is using this key, and I will probably need to understand this for production
     DATABASE_URL = os.getenv('DATABASE_URL', 'sqlite:///database.db')
+    if DATABASE_URL.startswith('postgres://'): # Heroku style URL, SQLAlchemy only accepts the postgresql:// scheme
+        DATABASE_URL = 'postgresql://' + DATABASE_URL[len('postgres://'):]
 
-    SQLALCHEMY_DATABASE_URI = DATABASE_URL
\ No newline at end of file
+    SQLALCHEMY_DATABASE_URI = DATABASE_URL
+
+    # Connection pool of each gunicorn worker. Every worker thread holds at most one connection, so the pool defaults to
+    # the number of threads in gunicorn_config.py, the overflow covers the ingest writer thread and the live streams.
+    # With 4 workers that is up to 4 * (DB_POOL_SIZE + DB_MAX_OVERFLOW) connections on the database server.
+    DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', os.getenv('GUNICORN_THREADS', 4)))
+    DB_MAX_OVERFLOW = int(os.getenv('DB_MAX_OVERFLOW', 4))
+    SQLALCHEMY_ENGINE_OPTIONS = {} if DATABASE_URL.startswith('sqlite') else {
+        'pool_size': DB_POOL_SIZE,
+        'max_overflow': DB_MAX_OVERFLOW,
+        'pool_pre_ping': True, # drop connections the server closed while they were idle in the pool
+        'pool_recycle': 1800,
+    }
+
+    # Create the missing tables and indexes in create_app. gunicorn_config.py turns this off for the workers and does it
+    # once in the master process instead, "flask --app main init-db" does it from a deploy script.
+    SCHEMA_INIT_ON_STARTUP = os.getenv('SCHEMA_INIT_ON_STARTUP', '1') == '1'
+    ADMIN_ENABLED = os.getenv('ADMIN_ENABLED', '1') == '1' # the /admin views, 0 skips importing Flask-Admin at all
+
+    # Telemetry ingest API. Devices authenticate with the X-API-Key header, logged in users can also post for their own devices.
+    INGEST_API_KEY = os.getenv('INGEST_API_KEY')
+    INGEST_MAX_BATCH = int(os.getenv('INGEST_MAX_BATCH', 10000)) # max samples accepted in a single request
+
+    # With INGEST_ASYNC=1 samples are acknowledged once queued, and a background thread per worker writes them in batches
+    INGEST_ASYNC = os.getenv('INGEST_ASYNC', '0') == '1'
+    INGEST_QUEUE_MAX_SAMPLES = int(os.getenv('INGEST_QUEUE_MAX_SAMPLES', 200000)) # uploads get a 503 beyond this many queued samples
+    INGEST_FLUSH_SAMPLES = int(os.getenv('INGEST_FLUSH_SAMPLES', 5000)) # write as soon as this many samples are queued...
+    INGEST_FLUSH_INTERVAL = float(os.getenv('INGEST_FLUSH_INTERVAL', 1.0)) # ...or after this many seconds
+    INGEST_SPILL_DIR = os.getenv('INGEST_SPILL_DIR') # where samples go when the database is unavailable, defaults to the instance folder
+
+    DEVICE_CACHE_SIZE = int(os.getenv('DEVICE_CACHE_SIZE', 10000)) # serial numbers kept in the per worker device lookup cache
+    DEVICE_CACHE_TTL = float(os.getenv('DEVICE_CACHE_TTL', 60)) # seconds, how long another worker can map a serial number to a renamed or deleted device
+    USER_CACHE_SIZE = int(os.getenv('USER_CACHE_SIZE', 10000)) # logged in users (and their device lists) cached per worker
+    USER_CACHE_TTL = float(os.getenv('USER_CACHE_TTL', 60)) # seconds, how long another worker can serve a stale name or device list
+
+    # Charts on /user_data are downsampled to at most this many points, with 'lttb' (Largest-Triangle-Three-Buckets) or 'minmax'
+    CHART_MAX_POINTS = max(int(os.getenv('CHART_MAX_POINTS', 2000)), 6) # at least the 3 points LTTB keeps for each of the two values
+    CHART_DOWNSAMPLE = os.getenv('CHART_DOWNSAMPLE', 'lttb')
+    # Payloads of /api/devices/<id>/series are cached until the device gets new samples (see chart_cache.py), and at most
+    # CHART_CACHE_TTL seconds. Other workers notice new samples within CHART_CACHE_WATERMARK_TTL seconds, or at once when
+    # they share CHART_CACHE_DIR (a local directory, e.g. on tmpfs).
+    CHART_CACHE_SIZE = int(os.getenv('CHART_CACHE_SIZE', 256)) # payloads kept in memory per worker
+    CHART_CACHE_TTL = float(os.getenv('CHART_CACHE_TTL', 300))
+    CHART_CACHE_WATERMARK_TTL = float(os.getenv('CHART_CACHE_WATERMARK_TTL', 10))
+    CHART_CACHE_DIR = os.getenv('CHART_CACHE_DIR')
+    COMPARE_MAX_DEVICES = int(os.getenv('COMPARE_MAX_DEVICES', 50)) # devices charted together by /user_data/compare
+    DATA_PAGE_MAX_LIMIT = int(os.getenv('DATA_PAGE_MAX_LIMIT', 10000)) # max rows per page of /api/devices/<id>/data
+    EXPORT_CHUNK_SIZE = int(os.getenv('EXPORT_CHUNK_SIZE', 10000)) # rows fetched and written at a time by /user_data/export
+
+    # Rehab analytics of /user_data (see analytics.py): a silence longer than ANALYTICS_SESSION_GAP_SECONDS starts a new
+    # session, and the range of motion is averaged over the last ANALYTICS_ROLLING_SESSIONS sessions
+    ANALYTICS_SESSION_GAP_SECONDS = int(os.getenv('ANALYTICS_SESSION_GAP_SECONDS', 1800))
+    ANALYTICS_ROLLING_SESSIONS = int(os.getenv('ANALYTICS_ROLLING_SESSIONS', 5))
+    ANALYTICS_CACHE_SIZE = int(os.getenv('ANALYTICS_CACHE_SIZE', 1000)) # devices whose analytics are kept per worker
+
+    # Months of samples older than this many days are compacted into DeviceDataArchive by
+    # "python -m website.db_utils --archive", the charts and exports read both tiers
+    ARCHIVE_AFTER_DAYS = int(os.getenv('ARCHIVE_AFTER_DAYS', 180))
+
+    # Build the fingerprinted CSS/JS and the image variants (see assets.py) when the app starts, instead of running
+    # "python -m website.assets" at deploy time. Only files whose source changed are rebuilt.
+    ASSETS_BUILD_ON_STARTUP = os.getenv('ASSETS_BUILD_ON_STARTUP', '0') == '1'
+
+    # Live updates of /user_data (Server-Sent Events). Every open stream holds a thread of a gthread worker, so by default a
+    # worker serves streams on at most half of its GUNICORN_THREADS and keeps the others for regular requests. Pages that
+    # don't get a stream poll /user_data/points every LIVE_POLL_INTERVAL seconds instead. With GUNICORN_WORKER_CLASS=gevent
+    # (pip install gevent) streams are cheap greenlets and the default allows hundreds per worker.
+    LIVE_MAX_SUBSCRIBERS = int(os.getenv('LIVE_MAX_SUBSCRIBERS', 500 if os.getenv('GUNICORN_WORKER_CLASS') == 'gevent'
+                                         else max(int(os.getenv('GUNICORN_THREADS', 4)) // 2, 1))) # open streams per worker
+    LIVE_MAX_PENDING = int(os.getenv('LIVE_MAX_PENDING', 5000)) # points buffered per stream before it falls back to the database
+    LIVE_POLL_INTERVAL = float(os.getenv('LIVE_POLL_INTERVAL', 5.0)) # seconds between database checks of a stream, and between polls of pages without one
+
+    # Request profiling: per route wall time, SQL statement count and SQL time on /metrics (Prometheus text format).
+    # A request running the same SQL statement PROFILING_N_PLUS_ONE_THRESHOLD times or more is logged as a likely N+1 query.
+    PROFILING = os.getenv('PROFILING', '0') == '1'
+    PROFILING_N_PLUS_ONE_THRESHOLD = int(os.getenv('PROFILING_N_PLUS_ONE_THRESHOLD', 5))
+    PROFILING_SLOW_REQUEST_SECONDS = float(os.getenv('PROFILING_SLOW_REQUEST_SECONDS', 0)) # log requests slower than this, 0 disables the log
+    METRICS_TOKEN = os.getenv('METRICS_TOKEN') # if set, /metrics requires an "Authorization: Bearer <token>" header
@@ -0,0 +1,22 @@
+# db_access.py
+# Raw SQL access through the app's SQLAlchemy engine, so every query shares its connection pool (sized by
+# DB_POOL_SIZE / DB_MAX_OVERFLOW in config.py). Large reads are streamed in fixed-size chunks: on Postgres
+# stream_results runs them on a named server-side cursor, so the whole table is never loaded in memory.
+
+from sqlalchemy import text
+
+from . import db
+
+
+def _statement(sql):
+    return text(sql) if isinstance(sql, str) else sql
+
+
+def stream_rows(sql, params=None, chunk_size=10000):
+    # Yields lists of at most chunk_size rows. The connection goes back to the pool once the generator is exhausted
+    # or closed.
+    with db.engine.connect() as connection:
+        result = connection.execution_options(stream_results=True, max_row_buffer=chunk_size).execute(_statement(sql), params or {})
+        for rows in result.partitions(chunk_size):
+            yield rows
+
@@ -1,7 +1,15 @@
-from .models import User, Device, DeviceData
+from .models import User, UserSnapshot, Device, DeviceData
 from werkzeug.security import generate_password_hash
 from . import db
-from sqlalchemy import func
+from .cache import device_cache, user_cache, user_devices_cache
+from .rollups import update_rollups, rebuild_rollups
+from .archive import archive_device_data
+from .live import live_feed
+from .chart_cache import note_new_rows
+from sqlalchemy import func, insert
+from sqlalchemy.orm import joinedload
+from datetime import datetime, timezone
+import math
 
 # Add a new user
 def add_user(email, password, first_name):
@@ -33,16 +41,172 @@ def add_device(name, device_type, serial_number, user_id):
 #     else:
 #         print(f'Device with id {device_id} does not exist.')
 
+def resolve_devices(serial_numbers):
+    # Map serial numbers to (device_id, user_id) through the device cache, looking up the misses with one query.
+    # Unknown serial numbers are left out of the result.
+    resolved = {}
+    missing = []
+    for serial_number in serial_numbers:
+        device = device_cache.get(serial_number)
+        if device is None:
+            missing.append(serial_number)
+        else:
+            resolved[serial_number] = device
+    if missing:
+        query = db.session.query(Device.serial_number, Device.id, Device.user_id).filter(Device.serial_number.in_(missing))
+        for serial_number, device_id, user_id in query:
+            resolved[serial_number] = (device_id, user_id)
+            device_cache.set(serial_number, (device_id, user_id))
+    return resolved
+
+def resolve_device(serial_number):
+    return resolve_devices([serial_number]).get(serial_number)
+
+def invalidate_device(*serial_numbers):
+    # Call after committing a change to a device's serial number, owner or existence
+    for serial_number in serial_numbers:
+        device_cache.invalidate(serial_number)
+
+def load_user_snapshot(user_id):
+    # Used by the login manager's user_loader, returns None for unknown users (which logs the session out)
+    user = user_cache.get(user_id)
+    if user is None:
+        row = db.session.query(User.id, User.email, User.first_name).filter_by(id=user_id).first()
+        if row is None:
+            return None
+        user = UserSnapshot(*row)
+        user_cache.set(user_id, user)
+    return user
+
+def list_user_devices(user_id):
+    # The user's devices as dicts (id, name, type, serial_number) through the per user device list cache
+    devices = user_devices_cache.get(user_id)
+    if devices is None:
+        query = db.session.query(Device.id, Device.name, Device.type, Device.serial_number).filter_by(user_id=user_id).order_by(Device.id)
+        devices = [dict(row._mapping) for row in query]
+        user_devices_cache.set(user_id, devices)
+    return devices
+
+def invalidate_user_devices(*user_ids):
+    # Call after committing a change to the devices of a user
+    for user_id in user_ids:
+        user_devices_cache.invalidate(user_id)
+
 def add_device_data(serial_number, value1, value2):
-    device = Device.query.filter_by(serial_number=serial_number).first()  # Query by serial_number
+    device = resolve_device(serial_number)  # Query by serial_number
     if device:
-        new_data = DeviceData(device_id=device.id, value1=value1, value2=value2)  # Use device ID here, not serial_number
+        row = {'device_id': device[0], 'timestamp': datetime.now(timezone.utc), 'value1': value1, 'value2': value2}  # Use device ID here, not serial_number
+        new_data = DeviceData(**row)
         db.session.add(new_data)
+        update_rollups([row])
         db.session.commit()
+        row['id'] = new_data.id
+        note_new_rows([row])
+        live_feed.publish([row])
         print(f'Data for Device {serial_number} added successfully!')
     else:
         print(f'Device with SN {serial_number} does not exist.')
 
+MAX_REPORTED_ERRORS = 100 # keep the batch response small when a device sends a lot of bad samples
+
+def parse_timestamp(value):
+    # Accepts ISO 8601 strings or epoch seconds, returns an aware UTC datetime. Naive values are treated as UTC.
+    # Raises ValueError for anything else, including timestamps a datetime can't hold (1e20, inf).
+    if value is None:
+        return datetime.now(timezone.utc)
+    if isinstance(value, bool):
+        raise ValueError('timestamp must be an ISO 8601 string or epoch seconds')
+    if isinstance(value, (int, float)):
+        try:
+            return datetime.fromtimestamp(value, tz=timezone.utc)
+        except (OverflowError, OSError) as e:
+            raise ValueError('timestamp is out of range') from e
+    if isinstance(value, str):
+        parsed = datetime.fromisoformat(value.strip().replace('Z', '+00:00'))
+        if parsed.tzinfo is None:
+            return parsed.replace(tzinfo=timezone.utc)
+        try:
+            return parsed.astimezone(timezone.utc)
+        except OverflowError as e:  # e.g. 0001-01-01T00:00:00+01:00
+            raise ValueError('timestamp is out of range') from e
+    raise ValueError('timestamp must be an ISO 8601 string or epoch seconds')
+
+def _parse_value(value):
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        raise ValueError('values must be numbers')
+    value = float(value)
+    if not math.isfinite(value):
+        raise ValueError('values must be finite numbers')
+    return value
+
+def validate_device_data_batch(samples, owner_id=None):
+    # Turns a batch of samples into DeviceData rows (dicts) ready for write_device_data.
+    # samples is a list of dicts (serial_number, timestamp, value1, value2) or [serial_number, timestamp, value1, value2] lists.
+    # If owner_id is given, samples for devices belonging to other users are rejected.
+    # Returns (rows, errors), errors holds at most MAX_REPORTED_ERRORS {'index', 'error'} entries.
+    normalized = []
+    for sample in samples:
+        if isinstance(sample, dict):
+            normalized.append((sample.get('serial_number'), sample.get('timestamp'), sample.get('value1'), sample.get('value2')))
+        elif isinstance(sample, (list, tuple)) and len(sample) == 4:
+            normalized.append(tuple(sample))
+        else:
+            normalized.append(None)
+
+    # Resolve every serial number in the batch at once, cached devices don't need a query at all
+    serial_numbers = {sample[0] for sample in normalized if sample is not None and isinstance(sample[0], str)}
+    devices = resolve_devices(serial_numbers)
+
+    rows = []
+    errors = []
+    for index, sample in enumerate(normalized):
+        try:
+            if sample is None:
+                raise ValueError('sample must be an object or a [serial_number, timestamp, value1, value2] list')
+            serial_number, timestamp, value1, value2 = sample
+            device = devices.get(serial_number) if isinstance(serial_number, str) else None
+            if device is None or (owner_id is not None and device[1] != owner_id):
+                raise ValueError(f'unknown device {serial_number!r}')
+            rows.append({
+                'device_id': device[0],
+                'timestamp': parse_timestamp(timestamp),
+                'value1': _parse_value(value1),
+                'value2': _parse_value(value2),
+            })
+        except (ValueError, TypeError, OverflowError, OSError) as e:
+            if len(errors) < MAX_REPORTED_ERRORS:
+                errors.append({'index': index, 'error': str(e)})
+    return rows, errors
+
+DATA_COLUMNS = ('device_id', 'timestamp', 'value1', 'value2')
+
+def write_device_data(rows):
+    # Inserts validated rows with one executemany and updates the rollups, all in a single transaction.
+    # Works on copies of the rows: the new ids only exist once the commit succeeded, and the copies that carry them are
+    # published to the live feed. The caller's dicts are left as they were, so a failed batch can be retried or spilled.
+    if not rows:
+        return
+    rows = [{column: row[column] for column in DATA_COLUMNS} for row in rows]
+    table = DeviceData.__table__
+    try:
+        result = db.session.execute(insert(table).returning(table.c.id, sort_by_parameter_order=True), rows)
+        data_ids = result.scalars().all()
+        update_rollups(rows)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    for row, data_id in zip(rows, data_ids):
+        row['id'] = data_id
+    note_new_rows(rows) # the cached chart payloads of these devices are out of date now
+    live_feed.publish(rows)
+
+def add_device_data_batch(samples, owner_id=None):
+    # Insert many samples in a single transaction with one executemany, instead of one commit per sample like add_device_data
+    rows, errors = validate_device_data_batch(samples, owner_id)
+    write_device_data(rows)
+    return {'accepted': len(rows), 'rejected': len(samples) - len(rows), 'errors': errors}
+
 
 def list_users():
     users = User.query.all()
@@ -69,7 +233,7 @@ def list_devices_for_user(user_id):
         print(f"User with ID {user_id} not found.")
 
 def list_all_devices():
-    devices = Device.query.all()
+    devices = Device.query.options(joinedload(Device.owner)).all()  # load the owners in the same query, not one query per device
     if devices:
         print(f"{'Device ID':<10} {'Device Name':<25} {'Device Type':<25} {'Owner Email':<30}")
         print("=" * 90)
@@ -81,7 +245,8 @@ def list_all_devices():
 
 
 def list_device_data(serial_number):
-    device = Device.query.filter_by(serial_number=serial_number).first()
+    resolved = resolve_device(serial_number)
+    device = db.session.get(Device, resolved[0]) if resolved else None
     if device:
         if device.data_points:
             print(f"Data points for {device.name} (Serial: {device.serial_number}):")
@@ -109,21 +274,49 @@ if __name__ == '__main__':
     parser.add_argument('--list-users', action='store_true', help="List all users")
     parser.add_argument('--list-devices-for-user', type=int, help="List devices for a specific user by user ID")
     parser.add_argument('--list-all-devices', action='store_true', help="List all devices")
-    parser.add_argument('--list-device-data', type=int, help="List data points for a specific device by device ID")
+    parser.add_argument('--list-device-data', type=str, metavar='SERIAL_NUMBER', help="List data points for a specific device by serial number")
     parser.add_argument('--find-user-by-email', type=str, help="Find a user by their email")
+    parser.add_argument('--backfill-rollups', nargs='?', type=int, const=0, metavar='DEVICE_ID', help="Rebuild the minute/hour/day rollups from the raw data, for one device or all devices")
+    parser.add_argument('--archive', nargs='?', type=int, const=-1, metavar='DAYS', help="Compact the months older than DAYS (default ARCHIVE_AFTER_DAYS) into the compressed archive")
+    parser.add_argument('--import-device-data', type=str, metavar='PATH', help="Bulk import samples (serial_number, timestamp, value1, value2) from a CSV or NDJSON file, - for stdin")
+    parser.add_argument('--dump-device-data', type=str, metavar='PATH', help="Write every sample, hot and archived, to a CSV or NDJSON file, - for stdout")
+    parser.add_argument('--format', choices=['csv', 'ndjson'], help="File format of --import-device-data / --dump-device-data, by default from the file name")
+    parser.add_argument('--serial-number', type=str, help="Only dump the samples of this device")
+    parser.add_argument('--chunk-size', type=int, default=50000, help="Samples per transaction of an import, and per read of a dump")
+    parser.add_argument('--drop-indexes', action='store_true', help="Drop the device_data indexes during the import and rebuild them at the end")
     
     args = parser.parse_args()
-    
-    if args.list_users:
-        list_users()
-    elif args.list_devices_for_user:
-        list_devices_for_user(args.list_devices_for_user)
-    elif args.list_all_devices:
-        list_all_devices()
-    elif args.list_device_data:
-        list_device_data(args.list_device_data)
-    elif args.find_user_by_email:
-        find_user_by_email(args.find_user_by_email)
+
+    import contextlib
+    import sys
+    from flask import current_app
+    from . import create_app
+    # A dump to stdout (-) must only contain the samples, everything else is printed to stderr
+    to_stdout = args.dump_device_data == '-'
+    progress = print if not to_stdout else lambda message: print(message, file=sys.stderr)
+    with contextlib.redirect_stdout(sys.stderr if to_stdout else sys.stdout):
+        app = create_app()
+    with app.app_context():
+        if args.list_users:
+            list_users()
+        elif args.list_devices_for_user:
+            list_devices_for_user(args.list_devices_for_user)
+        elif args.list_all_devices:
+            list_all_devices()
+        elif args.list_device_data:
+            list_device_data(args.list_device_data)
+        elif args.find_user_by_email:
+            find_user_by_email(args.find_user_by_email)
+        elif args.backfill_rollups is not None:
+            rebuild_rollups(args.backfill_rollups or None)
+        elif args.archive is not None:
+            archive_device_data(args.archive if args.archive >= 0 else current_app.config['ARCHIVE_AFTER_DAYS'])
+        elif args.import_device_data:
+            from .bulk import import_device_data
+            import_device_data(args.import_device_data, args.format, args.chunk_size, args.drop_indexes)
+        elif args.dump_device_data:
+            from .bulk import dump_device_data
+            dump_device_data(args.dump_device_data, args.format, args.serial_number, args.chunk_size, progress)
 
 
 ## Usage
@@ -146,6 +339,11 @@ if __name__ == '__main__':
 # Example command to add data for a device with device_id=1
 # add_device_data(device_id=SN123456, value1=50.5, value2=30.7) # tag: usage-serial-number-change -> this device id was changed to relate to serial number in models.py
 
+# 4.
+# from website.db_utils import add_device_data_batch
+# Example command to add several samples in one transaction
+# add_device_data_batch([{'serial_number': 'SN123456', 'timestamp': '2024-09-01T10:00:00Z', 'value1': 50.5, 'value2': 30.7}, ['SN123456', 1725184860, 51.0, 31.2]])
+
 
 
 ## Example CLI Commands
@@ -159,8 +357,26 @@ if __name__ == '__main__':
 # List all devices:
 # python db_utils.py --list-all-devices
 
-# List data points for a device with ID 2:
-# python db_utils.py --list-device-data 2
+# List data points for the device with serial number SN123456:
+# python db_utils.py --list-device-data SN123456
 
 # Find user by email:
 # python db_utils.py --find-user-by-email 'user@example.com'
+
+# Rebuild the rollups of all devices (or of the device with ID 2) after upgrading an existing database:
+# python -m website.db_utils --backfill-rollups
+# python -m website.db_utils --backfill-rollups 2
+
+# Move the samples older than ARCHIVE_AFTER_DAYS (or than 90 days) into the compressed archive, e.g. from a daily cron job:
+# python -m website.db_utils --archive
+# python -m website.db_utils --archive 90
+
+
+# Backfill historical device logs (CSV with a serial_number,timestamp,value1,value2 header, or NDJSON), 50000 samples per
+# transaction. --drop-indexes rebuilds the device_data index once at the end, worth it for imports of millions of rows:
+# python -m website.db_utils --import-device-data logs.csv.gz --drop-indexes
+# python -m website.db_utils --import-device-data logs.ndjson --chunk-size 100000
+
+# Dump every sample (or those of one device) in the same format, e.g. to move them to another database:
+# python -m website.db_utils --dump-device-data all.csv.gz
+# python -m website.db_utils --dump-device-data - --format ndjson --serial-number SN123456
@@ -0,0 +1,86 @@
+# downsample.py
+# Reduce long telemetry series to a few thousand points for the charts while keeping their visual shape.
+# All functions work on NumPy column arrays and return the indices of the points to keep.
+
+import numpy as np
+
+
+def _fill_gaps(y):
+    # Missing values (NULL in the database) don't take part in the point selection
+    y = np.asarray(y, dtype=np.float64)
+    missing = np.isnan(y)
+    if missing.any():
+        y = np.where(missing, 0.0 if missing.all() else np.nanmean(y), y)
+    return y
+
+
+def lttb_indices(x, y, n_out):
+    # Largest-Triangle-Three-Buckets: keeps the first and last point, and from each bucket in between the point forming
+    # the largest triangle with the previously kept point and the average of the next bucket. Budgets below 3 are
+    # raised to 3, the first, the last and one point in between.
+    n = len(x)
+    n_out = max(n_out, 3)
+    if n_out >= n:
+        return np.arange(n)
+
+    x = np.asarray(x, dtype=np.float64) - x[0]
+    y = _fill_gaps(y)
+
+    # n_out - 2 buckets over the points between the first and the last one
+    edges = np.linspace(1, n - 1, n_out - 1).astype(np.int64)
+    starts, ends = edges[:-1], edges[1:]
+
+    # Bucket averages from cumulative sums, the last bucket looks ahead to the final point
+    cum_x = np.concatenate(([0.0], np.cumsum(x)))
+    cum_y = np.concatenate(([0.0], np.cumsum(y)))
+    counts = ends - starts
+    next_x = np.append(((cum_x[ends] - cum_x[starts]) / counts)[1:], x[-1])
+    next_y = np.append(((cum_y[ends] - cum_y[starts]) / counts)[1:], y[-1])
+
+    selected = np.empty(n_out, dtype=np.int64)
+    selected[0] = 0
+    selected[-1] = n - 1
+    a = 0
+    for i in range(n_out - 2):
+        s, e = starts[i], ends[i]
+        area = np.abs((x[a] - next_x[i]) * (y[s:e] - y[a]) - (x[a] - x[s:e]) * (next_y[i] - y[a]))
+        a = s + int(area.argmax())
+        selected[i + 1] = a
+    return selected
+
+
+def minmax_indices(y, n_buckets):
+    # Keeps the minimum and the maximum of each of n_buckets equally sized buckets (at least one), fully vectorized
+    n = len(y)
+    n_buckets = max(n_buckets, 1)
+    if 2 * n_buckets >= n:
+        return np.arange(n)
+
+    y = np.asarray(y, dtype=np.float64)
+    bucket_size = -(-n // n_buckets)
+    n_buckets = -(-n // bucket_size)
+    padding = n_buckets * bucket_size - n
+
+    # Pad with +inf/-inf (and treat missing values the same way) so they are never picked as a min or a max
+    low = np.concatenate((np.where(np.isnan(y), np.inf, y), np.full(padding, np.inf))).reshape(n_buckets, bucket_size)
+    high = np.concatenate((np.where(np.isnan(y), -np.inf, y), np.full(padding, -np.inf))).reshape(n_buckets, bucket_size)
+    offsets = np.arange(n_buckets) * bucket_size
+    indices = np.concatenate((offsets + low.argmin(axis=1), offsets + high.argmax(axis=1)))
+    return np.unique(indices[indices < n])
+
+
+def downsample(x, ys, max_points, method='lttb'):
+    # Indices (sorted) to keep so that every series in ys stays recognizable and at most max_points are returned.
+    # The point budget is split between the series and the selections are merged.
+    n = len(x)
+    if n <= max_points or not ys:
+        return np.arange(n)
+
+    budget = max_points // len(ys)
+    if method == 'minmax':
+        selections = [minmax_indices(y, budget // 2) for y in ys]
+    elif method == 'lttb':
+        selections = [lttb_indices(x, y, budget) for y in ys]
+    else:
+        raise ValueError(f'Unknown downsampling method {method!r}')
+    return np.unique(np.concatenate(selections))
@@ -0,0 +1,84 @@
+# export.py
+# Streams device data as CSV or Parquet, chunk by chunk, so an export never holds the whole history in memory
+
+import csv
+from datetime import timezone
+import io
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # Parquet export is optional, install pyarrow to enable it
+    pa = None
+    pq = None
+
+EXPORT_FORMATS = {
+    'csv': 'text/csv',
+    'parquet': 'application/vnd.apache.parquet',
+}
+
+
+def parquet_available():
+    return pa is not None
+
+
+def iter_csv(chunks):
+    # chunks yields lists of (timestamp, value1, value2) rows
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(['timestamp', 'value1', 'value2'])
+    for rows in chunks:
+        # SQLite returns naive UTC timestamps and the archive aware ones, write them all with the +00:00 offset
+        writer.writerows(((timestamp if timestamp.tzinfo else timestamp.replace(tzinfo=timezone.utc)).isoformat(), value1, value2)
+                         for timestamp, value1, value2 in rows)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    yield buffer.getvalue()
+
+
+class _ChunkSink:
+    # Write-only file object for the ParquetWriter, the response takes whatever was written since the last drain
+    closed = False
+
+    def __init__(self):
+        self._parts = []
+        self._position = 0
+
+    def write(self, data):
+        self._parts.append(bytes(data))
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def drain(self):
+        data = b''.join(self._parts)
+        self._parts = []
+        return data
+
+
+def iter_parquet(chunks):
+    # One parquet row group per chunk
+    schema = pa.schema([('timestamp', pa.timestamp('us', tz='UTC')), ('value1', pa.float64()), ('value2', pa.float64())])
+    sink = _ChunkSink()
+    writer = pq.ParquetWriter(sink, schema, compression='snappy')
+    for rows in chunks:
+        timestamps, values1, values2 = zip(*rows)
+        writer.write_table(pa.table([list(timestamps), list(values1), list(values2)], schema=schema))
+        yield sink.drain()
+    writer.close()
+    yield sink.drain()
+
+
+def iter_export(export_format, chunks):
+    if export_format == 'parquet':
+        return iter_parquet(chunks)
+    return iter_csv(chunks)
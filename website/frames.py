@@ -0,0 +1,124 @@
+# frames.py
+# Compact binary upload format for the devices, posted to /api/ingest/frame. A frame carries many samples of one device
+# with the device's own sample times, at 12 bytes per sample with float32 values instead of ~70 bytes of JSON.
+# A request body is one or more frames back to back. Every field is little-endian:
+#
+#   magic          4 bytes   b'LMF1'
+#   version        uint8     1
+#   flags          uint8     bit 0 set: the values are float64, otherwise float32
+#   serial length  uint16    followed by the serial number, UTF-8
+#   start time     int64     epoch milliseconds
+#   count          uint32    number of samples
+#   deltas         uint32 x count   milliseconds since the previous sample, the first one since the start time
+#   value1         float32/float64 x count
+#   value2         float32/float64 x count
+#
+# The arrays are read with np.frombuffer straight from the request body instead of being parsed sample by sample.
+
+from datetime import datetime, timezone
+import struct
+
+import numpy as np
+
+from .db_utils import MAX_REPORTED_ERRORS
+
+FRAME_MAGIC = b'LMF1'
+FRAME_VERSION = 1
+FLAG_FLOAT64 = 0x01
+_HEADER = struct.Struct('<4sBBH')  # magic, version, flags, serial length
+_TIMING = struct.Struct('<qI')  # start time, count
+MAX_TIMESTAMP_MS = 253402300799999  # 9999-12-31T23:59:59.999Z, the last one a datetime can hold
+
+
+class FrameError(ValueError):
+    pass
+
+
+def encode_frame(serial_number, t_ms, values1, values2, float64=False):
+    # Builds a frame from sorted epoch millisecond timestamps and the two value arrays, for devices and tests
+    t_ms = np.asarray(t_ms, dtype=np.int64)
+    deltas = np.diff(t_ms, prepend=t_ms[:1])
+    if len(t_ms) and (deltas.min() < 0 or deltas.max() > np.iinfo(np.uint32).max):
+        raise ValueError('timestamps must be sorted and less than 49 days apart')
+    value_type = '<f8' if float64 else '<f4'
+    serial = serial_number.encode()
+    return b''.join((
+        _HEADER.pack(FRAME_MAGIC, FRAME_VERSION, FLAG_FLOAT64 if float64 else 0, len(serial)),
+        serial,
+        _TIMING.pack(int(t_ms[0]) if len(t_ms) else 0, len(t_ms)),
+        deltas.astype('<u4').tobytes(),
+        np.ascontiguousarray(values1, dtype=value_type).tobytes(),
+        np.ascontiguousarray(values2, dtype=value_type).tobytes(),
+    ))
+
+
+def decode_frames(data):
+    # Returns a list of (serial_number, t_ms, value1, value2) with int64 and float64 NumPy arrays.
+    # Raises FrameError if the body isn't a sequence of complete frames.
+    view = memoryview(data)
+    frames = []
+    offset = 0
+    while offset < len(view):
+        if len(view) - offset < _HEADER.size:
+            raise FrameError(f'Truncated frame header at byte {offset}')
+        magic, version, flags, serial_length = _HEADER.unpack_from(view, offset)
+        if magic != FRAME_MAGIC:
+            raise FrameError(f'Not a frame at byte {offset}')
+        if version != FRAME_VERSION:
+            raise FrameError(f'Unsupported frame version {version}')
+        offset += _HEADER.size
+
+        if len(view) - offset < serial_length + _TIMING.size:
+            raise FrameError(f'Truncated frame header at byte {offset}')
+        try:
+            serial_number = bytes(view[offset:offset + serial_length]).decode()
+        except UnicodeDecodeError:
+            raise FrameError('The serial number is not valid UTF-8') from None
+        offset += serial_length
+        start_ms, count = _TIMING.unpack_from(view, offset)
+        offset += _TIMING.size
+
+        value_type = np.dtype('<f8' if flags & FLAG_FLOAT64 else '<f4')
+        size = count * (4 + 2 * value_type.itemsize)
+        if len(view) - offset < size:
+            raise FrameError(f'Frame of {serial_number!r} announces {count} samples but the body ends before them')
+        deltas = np.frombuffer(view, dtype='<u4', count=count, offset=offset)
+        offset += 4 * count
+        values1 = np.frombuffer(view, dtype=value_type, count=count, offset=offset)
+        offset += value_type.itemsize * count
+        values2 = np.frombuffer(view, dtype=value_type, count=count, offset=offset)
+        offset += value_type.itemsize * count
+
+        t_ms = start_ms + np.cumsum(deltas, dtype=np.int64)
+        if count and (t_ms[0] < 0 or t_ms[-1] > MAX_TIMESTAMP_MS):
+            raise FrameError(f'Timestamps of {serial_number!r} are out of range')
+        frames.append((serial_number, t_ms, values1.astype(np.float64), values2.astype(np.float64)))
+    return frames
+
+
+def frames_to_rows(frames, devices, owner_id=None):
+    # Turns decoded frames into DeviceData rows (dicts) for write_device_data / the ingest queue. devices maps serial
+    # numbers to (device_id, user_id), see db_utils.resolve_devices. Samples with a NaN or infinite value are rejected
+    # like in the JSON API. Returns (rows, rejected count, errors), errors holds at most MAX_REPORTED_ERRORS entries.
+    rows = []
+    rejected = 0
+    errors = []
+    for index, (serial_number, t_ms, values1, values2) in enumerate(frames):
+        device = devices.get(serial_number)
+        if device is None or (owner_id is not None and device[1] != owner_id):
+            rejected += len(t_ms)
+            if len(errors) < MAX_REPORTED_ERRORS:
+                errors.append({'frame': index, 'error': f'unknown device {serial_number!r}'})
+            continue
+        finite = np.isfinite(values1) & np.isfinite(values2)
+        if not finite.all():
+            rejected += int((~finite).sum())
+            if len(errors) < MAX_REPORTED_ERRORS:
+                errors.append({'frame': index, 'error': f'{int((~finite).sum())} samples with non-finite values'})
+            t_ms, values1, values2 = t_ms[finite], values1[finite], values2[finite]
+        # One dict per sample is still built, that is what the bulk insert and the rollups take
+        device_id = device[0]
+        from_timestamp, utc = datetime.fromtimestamp, timezone.utc
+        rows.extend({'device_id': device_id, 'timestamp': from_timestamp(seconds, utc), 'value1': value1, 'value2': value2}
+                    for seconds, value1, value2 in zip((t_ms / 1000).tolist(), values1.tolist(), values2.tolist()))
+    return rows, rejected, errors
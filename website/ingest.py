@@ -0,0 +1,110 @@
+# ingest.py
+# JSON API used by the devices to upload telemetry in batches
+
+from functools import wraps
+import hmac
+
+from flask import Blueprint, request, jsonify, current_app, g
+from flask_login import current_user
+
+from .db_utils import add_device_data_batch, validate_device_data_batch, resolve_devices, write_device_data
+from .ingest_queue import ingest_queue
+from .frames import FrameError, decode_frames, frames_to_rows
+
+ingest = Blueprint('ingest', __name__)
+
+
+def ingest_auth_required(view):
+    # Devices authenticate with the INGEST_API_KEY in the X-API-Key header and can write to any registered device.
+    # A logged in user can also post, but only for devices they own.
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        api_key = current_app.config.get('INGEST_API_KEY')
+        provided_key = request.headers.get('X-API-Key', '')
+        if api_key and hmac.compare_digest(provided_key.encode(), api_key.encode()):
+            g.ingest_owner_id = None
+        elif current_user.is_authenticated:
+            g.ingest_owner_id = current_user.id
+        else:
+            return jsonify({'error': 'Authentication required'}), 401
+        return view(*args, **kwargs)
+    return wrapper
+
+
+@ingest.route('/api/ingest', methods=['POST'])
+@ingest_auth_required
+def ingest_batch():
+    # Body is either a list of samples or {"samples": [...]}, see db_utils.add_device_data_batch for the sample format.
+    # get_json only accepts application/json bodies, so this csrf exempt route can't be posted by a plain html form.
+    data = request.get_json(silent=True)
+    samples = data.get('samples') if isinstance(data, dict) else data
+    if not isinstance(samples, list):
+        return jsonify({'error': 'Expected a JSON list of samples'}), 400
+
+    max_batch = current_app.config['INGEST_MAX_BATCH']
+    if len(samples) > max_batch:
+        return jsonify({'error': f'Batch too large, send at most {max_batch} samples per request'}), 413
+
+    if not ingest_queue.enabled:
+        result = add_device_data_batch(samples, owner_id=g.ingest_owner_id)
+        return jsonify(result)
+
+    # Async mode: answer as soon as the valid samples are queued, the writer thread commits them shortly after
+    rows, errors = validate_device_data_batch(samples, owner_id=g.ingest_owner_id)
+    if not ingest_queue.enqueue(rows):
+        return jsonify({'error': 'Ingest queue is full, retry later'}), 503, {'Retry-After': '5'}
+    return jsonify({'accepted': len(rows), 'rejected': len(samples) - len(rows), 'errors': errors, 'queued': True}), 202
+
+
+def _read_at_most(stream, size):
+    chunks = []
+    remaining = size
+    while remaining > 0:
+        chunk = stream.read(min(remaining, 64 * 1024))
+        if not chunk:
+            break
+        chunks.append(chunk)
+        remaining -= len(chunk)
+    return b''.join(chunks)
+
+
+@ingest.route('/api/ingest/frame', methods=['POST'])
+@ingest_auth_required
+def ingest_frame():
+    # Binary upload: one or more frames (see frames.py) as an application/octet-stream body. Same answers as /api/ingest,
+    # the errors refer to frames instead of samples.
+    if request.mimetype != 'application/octet-stream':
+        return jsonify({'error': 'Expected an application/octet-stream body'}), 415
+    # Every sample takes at least 12 bytes, anything larger than INGEST_MAX_BATCH float64 samples is too much anyway
+    max_batch = current_app.config['INGEST_MAX_BATCH']
+    max_size = 64 * 1024 + max_batch * 20
+    if request.content_length is not None and request.content_length > max_size:
+        return jsonify({'error': f'Batch too large, send at most {max_batch} samples per request'}), 413
+    # A chunked upload has no Content-Length, the body is read up to one byte past the limit either way
+    body = _read_at_most(request.stream, max_size + 1)
+    if len(body) > max_size:
+        return jsonify({'error': f'Batch too large, send at most {max_batch} samples per request'}), 413
+
+    try:
+        frames = decode_frames(body)
+    except FrameError as e:
+        return jsonify({'error': str(e)}), 400
+    if sum(len(frame[1]) for frame in frames) > max_batch:
+        return jsonify({'error': f'Batch too large, send at most {max_batch} samples per request'}), 413
+
+    devices = resolve_devices({frame[0] for frame in frames})
+    rows, rejected, errors = frames_to_rows(frames, devices, owner_id=g.ingest_owner_id)
+    if not ingest_queue.enabled:
+        write_device_data(rows)
+        return jsonify({'accepted': len(rows), 'rejected': rejected, 'errors': errors})
+
+    if not ingest_queue.enqueue(rows):
+        return jsonify({'error': 'Ingest queue is full, retry later'}), 503, {'Retry-After': '5'}
+    return jsonify({'accepted': len(rows), 'rejected': rejected, 'errors': errors, 'queued': True}), 202
+
+
+@ingest.route('/api/ingest/metrics')
+@ingest_auth_required
+def ingest_metrics():
+    # Queue depth, flush latency and spill counters of this worker's ingest queue
+    return jsonify({'async': ingest_queue.enabled, **ingest_queue.metrics()})
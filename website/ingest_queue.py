@@ -0,0 +1,217 @@
+# ingest_queue.py
+# In-process ingestion queue: request handlers validate and enqueue samples, a background writer thread commits them in
+# large batches. Enabled with INGEST_ASYNC=1, otherwise /api/ingest writes synchronously.
+
+from collections import deque
+import atexit
+import glob
+import json
+import os
+import threading
+import time
+
+from sqlalchemy.exc import DataError, DBAPIError, IntegrityError, StatementError
+
+from .db_utils import write_device_data, parse_timestamp, DATA_COLUMNS
+
+SPILL_RETRY_SECONDS = 30 # after a failed write, wait this long before replaying spill files again
+
+
+def _is_permanent(error):
+    # Errors caused by the rows themselves (a deleted device, a bad value) fail again on every retry, unlike a lost
+    # connection or a locked database. DBAPIError is a StatementError too, only the others are about the statement.
+    if isinstance(error, (IntegrityError, DataError, ValueError, TypeError)):
+        return True
+    return isinstance(error, StatementError) and not isinstance(error, DBAPIError)
+
+
+class IngestQueue:
+    # Each gunicorn worker has its own queue and writer thread, started on first use (so after the fork).
+    # Samples that can't be written are appended to a spill file and replayed once the database accepts writes again.
+    # Replayed batches that fail because of their rows are split until the failing rows are found, those go to a
+    # dead letter file (ingest_dead_letter.*.ndjson, with the error) so the rest of the spill still gets through.
+
+    def __init__(self, app=None):
+        self.app = None
+        self._pending = deque()
+        self._condition = threading.Condition()
+        self._thread = None
+        self._pid = None
+        self._stopping = False
+        self._last_failure = 0.0
+        self._stats = {
+            'enqueued': 0,
+            'rejected_full': 0,
+            'written': 0,
+            'spilled': 0,
+            'replayed': 0,
+            'dead_lettered': 0,
+            'flushes': 0,
+            'flush_errors': 0,
+            'last_flush_seconds': 0.0,
+            'max_flush_seconds': 0.0,
+            'total_flush_seconds': 0.0,
+        }
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        self.enabled = app.config['INGEST_ASYNC']
+        self.max_samples = app.config['INGEST_QUEUE_MAX_SAMPLES']
+        self.flush_samples = app.config['INGEST_FLUSH_SAMPLES']
+        self.flush_interval = app.config['INGEST_FLUSH_INTERVAL']
+        self.spill_dir = app.config['INGEST_SPILL_DIR'] or app.instance_path
+        if self.enabled:
+            atexit.register(self.stop)
+
+    def enqueue(self, rows):
+        # Returns False without queuing anything when the queue is full, the caller should ask the device to retry later
+        self._ensure_worker()
+        with self._condition:
+            if len(self._pending) + len(rows) > self.max_samples:
+                self._stats['rejected_full'] += len(rows)
+                return False
+            now = time.monotonic()
+            self._pending.extend((now, row) for row in rows)
+            self._stats['enqueued'] += len(rows)
+            if len(self._pending) >= self.flush_samples:
+                self._condition.notify()
+        return True
+
+    def metrics(self):
+        with self._condition:
+            metrics = dict(self._stats)
+            metrics['depth'] = len(self._pending)
+            metrics['max_depth'] = self.max_samples
+            metrics['oldest_pending_seconds'] = time.monotonic() - self._pending[0][0] if self._pending else 0.0
+        metrics['avg_flush_seconds'] = metrics['total_flush_seconds'] / metrics['flushes'] if metrics['flushes'] else 0.0
+        metrics['spill_files'] = len(self._spill_files())
+        return metrics
+
+    def stop(self):
+        # Writes what is left in the queue (or spills it) before the worker exits
+        with self._condition:
+            self._stopping = True
+            self._condition.notify()
+        if self._thread is not None and self._thread.is_alive() and self._pid == os.getpid():
+            self._thread.join(timeout=self.flush_interval + 30)
+
+    def _ensure_worker(self):
+        if self._thread is not None and self._thread.is_alive() and self._pid == os.getpid():
+            return
+        with self._condition:
+            if self._thread is None or not self._thread.is_alive() or self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._stopping = False
+                self._thread = threading.Thread(target=self._run, name='ingest-writer', daemon=True)
+                self._thread.start()
+
+    def _take_batch(self):
+        with self._condition:
+            if not self._stopping and len(self._pending) < self.flush_samples:
+                self._condition.wait(timeout=self.flush_interval)
+            count = min(len(self._pending), self.flush_samples)
+            return [self._pending.popleft()[1] for _ in range(count)]
+
+    def _run(self):
+        while True:
+            rows = self._take_batch()
+            if rows and self._flush(rows) is not None:
+                self._spill(rows)
+            elif time.monotonic() - self._last_failure > SPILL_RETRY_SECONDS:
+                self._replay_spills()
+            with self._condition:
+                if self._stopping and not self._pending:
+                    return
+
+    def _flush(self, rows):
+        # Returns None once the rows are written, or the exception that made the write fail
+        started = time.monotonic()
+        try:
+            with self.app.app_context():
+                write_device_data(rows)
+        except Exception as e:
+            self.app.logger.error('Ingest queue flush of %d samples failed: %s', len(rows), e)
+            with self._condition:
+                self._stats['flush_errors'] += 1
+                self._last_failure = time.monotonic()
+            return e
+        elapsed = time.monotonic() - started
+        with self._condition:
+            self._stats['flushes'] += 1
+            self._stats['written'] += len(rows)
+            self._stats['last_flush_seconds'] = elapsed
+            self._stats['max_flush_seconds'] = max(self._stats['max_flush_seconds'], elapsed)
+            self._stats['total_flush_seconds'] += elapsed
+        return None
+
+    # Spill files hold one JSON row per line. Each process writes its own file, and a file is claimed by renaming it
+    # before it is replayed, so two workers never replay the same samples.
+
+    def _spill_files(self):
+        return glob.glob(os.path.join(self.spill_dir, 'ingest_spill.*.ndjson'))
+
+    def _append(self, name, lines):
+        os.makedirs(self.spill_dir, exist_ok=True)
+        path = os.path.join(self.spill_dir, f'{name}.{os.getpid()}.ndjson')
+        with open(path, 'a') as spill_file:
+            spill_file.writelines(line + '\n' for line in lines)
+            spill_file.flush()
+            os.fsync(spill_file.fileno())
+
+    def _spill(self, rows):
+        # Only the sample columns are kept, an id would clash with the rows committed in the meantime
+        self._append('ingest_spill', (json.dumps({**{column: row[column] for column in DATA_COLUMNS},
+                                                  'timestamp': row['timestamp'].isoformat()}) for row in rows))
+        with self._condition:
+            self._stats['spilled'] += len(rows)
+
+    def _dead_letter(self, lines, error):
+        self.app.logger.error('Ingest queue moved %d samples to the dead letter file: %s', len(lines), error)
+        self._append('ingest_dead_letter', (json.dumps({'row': line, 'error': str(error)}) for line in lines))
+        with self._condition:
+            self._stats['dead_lettered'] += len(lines)
+
+    def _replay(self, lines):
+        # Writes spilled lines, splitting a batch that fails because of its rows until the bad ones are isolated.
+        # Returns the lines left for a later replay when the database itself is unavailable.
+        try:
+            rows = [json.loads(line) for line in lines]
+            for row in rows:
+                row['timestamp'] = parse_timestamp(row['timestamp'])
+        except (ValueError, TypeError, KeyError, OverflowError, OSError) as e:
+            error = e
+        else:
+            error = self._flush(rows)
+            if error is None:
+                with self._condition:
+                    self._stats['replayed'] += len(rows)
+                return []
+            if not _is_permanent(error):
+                return lines
+        if len(lines) == 1:
+            self._dead_letter(lines, error)
+            return []
+        half = len(lines) // 2
+        left = self._replay(lines[:half])
+        return left + lines[half:] if left else self._replay(lines[half:])
+
+    def _replay_spills(self):
+        for path in self._spill_files():
+            claimed = f'{path}.replaying.{os.getpid()}'
+            try:
+                os.rename(path, claimed)
+            except OSError:
+                continue  # another worker got it first
+            with open(claimed) as spill_file:
+                lines = [line.strip() for line in spill_file if line.strip()]
+            for start in range(0, len(lines), self.flush_samples):
+                left = self._replay(lines[start:start + self.flush_samples])
+                if left:
+                    # Still unavailable, keep the lines for the next replay
+                    self._append('ingest_spill', left + lines[start + self.flush_samples:])
+                    break
+            os.remove(claimed)
+
+ingest_queue = IngestQueue()
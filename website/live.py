@@ -0,0 +1,83 @@
+# live.py
+# In-process pub/sub of newly written DeviceData rows, feeding the Server-Sent Events stream of the user_data page.
+# Only rows written by the same worker process are published, the stream polls the database for the others.
+
+from collections import defaultdict, deque
+import threading
+
+from .config import Config
+
+
+class Subscription:
+    def __init__(self, device_id, max_pending):
+        self.device_id = device_id
+        self.overflowed = False  # points were dropped, the reader has to catch up from the database
+        self._points = deque()
+        self._max_pending = max_pending
+        self._condition = threading.Condition()
+
+    def put(self, points):
+        with self._condition:
+            if len(self._points) + len(points) > self._max_pending:
+                self._points.clear()
+                self.overflowed = True
+            else:
+                self._points.extend(points)
+            self._condition.notify()
+
+    def get(self, timeout):
+        # Waits up to timeout seconds and returns the pending points (possibly none)
+        with self._condition:
+            if not self._points and not self.overflowed:
+                self._condition.wait(timeout=timeout)
+            points = list(self._points)
+            self._points.clear()
+            return points
+
+
+class LiveFeed:
+    def __init__(self, max_subscribers, max_pending):
+        self.max_subscribers = max_subscribers
+        self.max_pending = max_pending
+        self._subscriptions = defaultdict(set)
+        self._count = 0
+        self._lock = threading.Lock()
+
+    def subscribe(self, device_id):
+        # Returns None when this worker already serves max_subscribers streams
+        with self._lock:
+            if self._count >= self.max_subscribers:
+                return None
+            subscription = Subscription(device_id, self.max_pending)
+            self._subscriptions[device_id].add(subscription)
+            self._count += 1
+            return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            subscriptions = self._subscriptions.get(subscription.device_id)
+            if subscriptions and subscription in subscriptions:
+                subscriptions.remove(subscription)
+                self._count -= 1
+                if not subscriptions:
+                    del self._subscriptions[subscription.device_id]
+
+    def publish(self, rows):
+        # rows are committed DeviceData rows as dicts (id, device_id, timestamp, value1, value2)
+        with self._lock:
+            if not self._subscriptions:
+                return
+            by_device = defaultdict(list)
+            for row in rows:
+                if row['device_id'] in self._subscriptions:
+                    by_device[row['device_id']].append(row)
+            targets = [(subscription, by_device[device_id]) for device_id in by_device for subscription in self._subscriptions[device_id]]
+        for subscription, points in targets:
+            subscription.put(points)
+
+    def stats(self):
+        with self._lock:
+            return {'subscribers': self._count, 'devices': len(self._subscriptions), 'max_subscribers': self.max_subscribers}
+
+
+live_feed = LiveFeed(max_subscribers=Config.LIVE_MAX_SUBSCRIBERS, max_pending=Config.LIVE_MAX_PENDING)
@@ -22,6 +22,17 @@ class User(db.Model, UserMixin):
     def __repr__(self):
         return f'<User {self.email}>'
 
+class UserSnapshot(UserMixin):
+    # Read only copy of the user columns the routes and templates use. The user_loader returns one from the user
+    # cache, so current_user doesn't cost a query per request. Load the User itself for anything else.
+    def __init__(self, id, email, first_name):
+        self.id = id
+        self.email = email
+        self.first_name = first_name
+
+    def __repr__(self):
+        return f'<UserSnapshot {self.email}>'
+
 class Device(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(150))
@@ -34,6 +45,9 @@ class Device(db.Model):
         return f'<Device {self.name}>'
 
 class DeviceData(db.Model):
+    # Every read is "samples of one device in a time range", this index turns those into range scans
+    __table_args__ = (db.Index('ix_device_data_device_id_timestamp', 'device_id', 'timestamp'),)
+
     id = db.Column(db.Integer, primary_key=True)
     device_id = db.Column(db.Integer, db.ForeignKey('device.id'), nullable=False)  # Reference Device.id, not serial_number
     timestamp = db.Column(db.DateTime(timezone=True), default=func.now())
@@ -43,9 +57,74 @@ class DeviceData(db.Model):
     def __repr__(self):
         return f'<DeviceData {self.id} for Device {self.device_id}>'
 
+class DeviceDataRollup(db.Model):
+    # Aggregates of DeviceData per device and time bucket, one row per (device, resolution, bucket).
+    # Kept up to date by the ingest path, see rollups.py.
+    device_id = db.Column(db.Integer, db.ForeignKey('device.id'), primary_key=True)
+    resolution = db.Column(db.String(10), primary_key=True)  # 'minute', 'hour' or 'day'
+    bucket_start = db.Column(db.DateTime(timezone=True), primary_key=True)
+    count = db.Column(db.Integer, nullable=False)
+    # Samples with a value, the means are sum / count of each value because missing values (NULL) aren't in the sums.
+    # Older databases get these by hand, then "python -m website.db_utils --backfill-rollups" fills them.
+    count1 = db.Column(db.Integer, nullable=False, server_default='0')
+    count2 = db.Column(db.Integer, nullable=False, server_default='0')
+    min1 = db.Column(db.Float)
+    max1 = db.Column(db.Float)
+    sum1 = db.Column(db.Float, nullable=False)
+    sumsq1 = db.Column(db.Float, nullable=False)
+    min2 = db.Column(db.Float)
+    max2 = db.Column(db.Float)
+    sum2 = db.Column(db.Float, nullable=False)
+    sumsq2 = db.Column(db.Float, nullable=False)
+
+    def __repr__(self):
+        return f'<DeviceDataRollup {self.resolution} {self.bucket_start} for Device {self.device_id}>'
+
+class DeviceDataArchive(db.Model):
+    # Cold tier: the samples of one device and calendar month (UTC), moved out of DeviceData by archive.py once the
+    # month is older than ARCHIVE_AFTER_DAYS. data is a compressed columnar chunk, see archive.encode_chunk.
+    device_id = db.Column(db.Integer, db.ForeignKey('device.id'), primary_key=True)
+    month_start = db.Column(db.DateTime(timezone=True), primary_key=True)
+    count = db.Column(db.Integer, nullable=False)
+    first_timestamp = db.Column(db.DateTime(timezone=True), nullable=False)
+    last_timestamp = db.Column(db.DateTime(timezone=True), nullable=False)
+    data = db.Column(db.LargeBinary, nullable=False)
+
+    def __repr__(self):
+        return f'<DeviceDataArchive {self.month_start} for Device {self.device_id}>'
+
 
 @event.listens_for(User.password, 'set', retval=True)
 def hash_user_password(target, value, oldvalue, initiator):
     if value != oldvalue:
         return generate_password_hash(value, method='pbkdf2:sha256')
-    return value
\ No newline at end of file
+    return value
+
+
+# The routes in auth.py invalidate the device cache after committing. These listeners also cover edits made
+# through the admin views or the flask shell.
+@event.listens_for(Device, 'after_update')
+@event.listens_for(Device, 'after_delete')
+def invalidate_cached_device(mapper, connection, target):
+    from .cache import device_cache
+    history = db.inspect(target).attrs.serial_number.history
+    for serial_number in [target.serial_number, *history.deleted]:
+        device_cache.invalidate(serial_number)
+
+
+@event.listens_for(Device, 'after_insert')
+@event.listens_for(Device, 'after_update')
+@event.listens_for(Device, 'after_delete')
+def invalidate_cached_device_list(mapper, connection, target):
+    from .cache import user_devices_cache
+    history = db.inspect(target).attrs.user_id.history
+    for user_id in {target.user_id, *history.deleted}:
+        user_devices_cache.invalidate(user_id)
+
+
+@event.listens_for(User, 'after_update')
+@event.listens_for(User, 'after_delete')
+def invalidate_cached_user(mapper, connection, target):
+    # Covers profile and password changes made from the routes, the admin views or the flask shell
+    from .cache import user_cache
+    user_cache.invalidate(target.id)
@@ -0,0 +1,170 @@
+# profiling.py
+# Opt-in request profiling (PROFILING=1). Records the wall time of every request per route, and the number and duration
+# of the SQL statements it ran through SQLAlchemy engine events. A request that runs the same statement many times is
+# flagged as a likely N+1 query. Everything is exposed in the Prometheus text format on /metrics.
+# The numbers are per process: with several gunicorn workers, each one reports its own requests.
+
+from collections import Counter, defaultdict
+import hmac
+import threading
+import time
+
+from flask import Response, current_app, g, has_request_context, request
+from sqlalchemy import event
+
+from . import db
+
+# Upper bounds (seconds) of the request duration histogram buckets
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _label_value(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(**labels):
+    return '{' + ','.join(f'{name}="{_label_value(value)}"' for name, value in labels.items()) + '}'
+
+
+class RouteStats:
+    def __init__(self):
+        self.requests = Counter()  # status code -> count
+        self.buckets = [0] * len(DURATION_BUCKETS)
+        self.duration_sum = 0.0
+        self.sql_statements = 0
+        self.sql_seconds = 0.0
+        self.n_plus_one = 0
+
+    def record(self, status, duration, sql_statements, sql_seconds, n_plus_one):
+        self.requests[status] += 1
+        for i, bound in enumerate(DURATION_BUCKETS):
+            if duration <= bound:
+                self.buckets[i] += 1
+        self.duration_sum += duration
+        self.sql_statements += sql_statements
+        self.sql_seconds += sql_seconds
+        self.n_plus_one += n_plus_one
+
+
+class RequestProfiler:
+    def __init__(self, app=None):
+        self._routes = defaultdict(RouteStats)  # (method, route) -> RouteStats
+        self._lock = threading.Lock()
+        self._engines = set()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        if not app.config['PROFILING']:
+            return
+        self.slow_request_seconds = app.config['PROFILING_SLOW_REQUEST_SECONDS']
+        self.n_plus_one_threshold = app.config['PROFILING_N_PLUS_ONE_THRESHOLD']
+        self.metrics_token = app.config['METRICS_TOKEN']
+
+        with app.app_context():
+            engine = db.engine
+        if engine not in self._engines:
+            event.listen(engine, 'before_cursor_execute', self._before_cursor_execute)
+            event.listen(engine, 'after_cursor_execute', self._after_cursor_execute)
+            self._engines.add(engine)
+
+        app.before_request(self._start_request)
+        app.after_request(self._finish_request)
+        app.add_url_rule('/metrics', 'metrics', self._metrics_view)
+
+    # SQL statements are only counted when they run inside a request, the ingest writer thread is not profiled
+
+    def _before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        if has_request_context() and 'profile_statements' in g:
+            conn.info.setdefault('profile_started', []).append(time.perf_counter())
+
+    def _after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        if has_request_context() and 'profile_statements' in g and conn.info.get('profile_started'):
+            g.profile_sql_seconds += time.perf_counter() - conn.info['profile_started'].pop()
+            g.profile_statements[statement] += 1
+
+    def _start_request(self):
+        g.profile_started = time.perf_counter()
+        g.profile_statements = Counter()  # statement text -> executions, parameters are bound separately
+        g.profile_sql_seconds = 0.0
+
+    def _finish_request(self, response):
+        if 'profile_started' not in g:
+            return response
+        duration = time.perf_counter() - g.profile_started
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        statements = g.profile_statements
+        sql_statements = sum(statements.values())
+        repeated = [(statement, count) for statement, count in statements.most_common(3) if count >= self.n_plus_one_threshold]
+
+        with self._lock:
+            self._routes[(request.method, route)].record(response.status_code, duration, sql_statements, g.profile_sql_seconds, bool(repeated))
+
+        if repeated:
+            statement, count = repeated[0]
+            current_app.logger.warning('Likely N+1 query in %s %s: statement ran %d times: %s',
+                                       request.method, route, count, ' '.join(statement.split())[:300])
+        if self.slow_request_seconds and duration >= self.slow_request_seconds:
+            current_app.logger.warning('Slow request %s %s (%s): %.3fs, %d SQL statements in %.3fs',
+                                       request.method, request.full_path.rstrip('?'), response.status_code,
+                                       duration, sql_statements, g.profile_sql_seconds)
+        return response
+
+    def _metrics_view(self):
+        if self.metrics_token:
+            provided = request.headers.get('Authorization', '').removeprefix('Bearer ')
+            if not hmac.compare_digest(provided.encode(), self.metrics_token.encode()):
+                return Response('Unauthorized\n', status=401, mimetype='text/plain')
+        return Response(self.render_metrics(), mimetype='text/plain; version=0.0.4')
+
+    def render_metrics(self):
+        lines = []
+
+        def metric(name, kind, help_text, samples):
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {kind}')
+            lines.extend(f'{name}{labels} {value}' for labels, value in samples)
+
+        with self._lock:
+            routes = sorted(self._routes.items())
+            metric('landmetrics_http_requests_total', 'counter', 'HTTP requests by route and status code.',
+                   [(_labels(method=method, route=route, status=status), count)
+                    for (method, route), stats in routes for status, count in sorted(stats.requests.items())])
+
+            lines.append('# HELP landmetrics_http_request_duration_seconds Request wall time in seconds.')
+            lines.append('# TYPE landmetrics_http_request_duration_seconds histogram')
+            for (method, route), stats in routes:
+                total = sum(stats.requests.values())
+                for bound, count in zip(DURATION_BUCKETS, stats.buckets):
+                    lines.append(f'landmetrics_http_request_duration_seconds_bucket{_labels(method=method, route=route, le=bound)} {count}')
+                lines.append(f'landmetrics_http_request_duration_seconds_bucket{_labels(method=method, route=route, le="+Inf")} {total}')
+                lines.append(f'landmetrics_http_request_duration_seconds_sum{_labels(method=method, route=route)} {stats.duration_sum:.6f}')
+                lines.append(f'landmetrics_http_request_duration_seconds_count{_labels(method=method, route=route)} {total}')
+
+            metric('landmetrics_sql_statements_total', 'counter', 'SQL statements executed while serving the route.',
+                   [(_labels(method=method, route=route), stats.sql_statements) for (method, route), stats in routes])
+            metric('landmetrics_sql_seconds_total', 'counter', 'Time spent in SQL statements while serving the route.',
+                   [(_labels(method=method, route=route), f'{stats.sql_seconds:.6f}') for (method, route), stats in routes])
+            metric('landmetrics_n_plus_one_requests_total', 'counter',
+                   f'Requests that ran an identical SQL statement at least {self.n_plus_one_threshold} times.',
+                   [(_labels(method=method, route=route), stats.n_plus_one) for (method, route), stats in routes])
+
+        # Process-local caches and queues of the other modules
+        from .cache import device_cache
+        from .ingest_queue import ingest_queue
+        from .live import live_feed
+        cache = device_cache.stats()
+        metric('landmetrics_device_cache_entries', 'gauge', 'Serial numbers in the device lookup cache.', [('', cache['size'])])
+        metric('landmetrics_device_cache_lookups_total', 'counter', 'Device cache lookups by result.',
+               [(_labels(result='hit'), cache['hits']), (_labels(result='miss'), cache['misses'])])
+        if ingest_queue.enabled:
+            queue = ingest_queue.metrics()
+            metric('landmetrics_ingest_queue_depth', 'gauge', 'Samples waiting for the ingest writer.', [('', queue['depth'])])
+            metric('landmetrics_ingest_samples_total', 'counter', 'Samples handled by the ingest queue by outcome.',
+                   [(_labels(outcome=outcome), queue[outcome]) for outcome in ('enqueued', 'rejected_full', 'written', 'spilled', 'replayed')])
+            metric('landmetrics_ingest_flush_errors_total', 'counter', 'Failed ingest queue flushes.', [('', queue['flush_errors'])])
+        metric('landmetrics_live_subscribers', 'gauge', 'Open live update streams.', [('', live_feed.stats()['subscribers'])])
+        return '\n'.join(lines) + '\n'
+
+
+profiler = RequestProfiler()
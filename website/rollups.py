@@ -0,0 +1,308 @@
+# rollups.py
+# Incrementally maintained minute/hour/day aggregates of DeviceData (count of samples, and count, min, max, sum and sum
+# of squares of both values), so the dashboard doesn't have to scan the raw samples for long time windows.
+
+from datetime import datetime, timezone
+
+import numpy as np
+from sqlalchemy import select, delete, func, case, bindparam
+
+from . import db
+from .models import Device, DeviceData, DeviceDataRollup, DeviceDataArchive
+from .series import to_epoch_ms
+from .archive import decode_chunk
+
+# From the finest to the coarsest, in milliseconds. Buckets are aligned on the epoch, so days are UTC days.
+RESOLUTIONS = {
+    'minute': 60 * 1000,
+    'hour': 60 * 60 * 1000,
+    'day': 24 * 60 * 60 * 1000,
+}
+
+# choose_resolution only charts rollups when the window holds more than RAW_BUDGET_FACTOR times the point budget in raw
+# samples, and when they give at least MIN_BUCKET_SHARE of the budget in buckets
+RAW_BUDGET_FACTOR = 10
+MIN_BUCKET_SHARE = 0.25
+
+
+def _ms_to_datetime(ms):
+    return datetime.fromtimestamp(ms / 1000, tz=timezone.utc)
+
+
+def floor_to_bucket(timestamp, resolution):
+    if timestamp.tzinfo is None:
+        timestamp = timestamp.replace(tzinfo=timezone.utc)
+    ms = int(timestamp.timestamp() * 1000)
+    return _ms_to_datetime(ms - ms % RESOLUTIONS[resolution])
+
+
+def _value_stats(values, starts):
+    # count, min, max, sum, sum of squares per group, missing values (NaN) are left out
+    missing = np.isnan(values)
+    low = np.minimum.reduceat(np.where(missing, np.inf, values), starts)
+    high = np.maximum.reduceat(np.where(missing, -np.inf, values), starts)
+    filled = np.where(missing, 0.0, values)
+    return (np.add.reduceat(~missing, starts, dtype=np.int64),
+            np.where(np.isinf(low), np.nan, low), np.where(np.isinf(high), np.nan, high),
+            np.add.reduceat(filled, starts), np.add.reduceat(filled * filled, starts))
+
+
+def _means(sums, counts):
+    # Mean per bucket, NaN (a gap in the chart) for buckets without any value
+    counts = np.asarray(counts, dtype=np.float64)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(counts > 0, np.asarray(sums, dtype=np.float64) / counts, np.nan)
+
+
+def aggregate(device_ids, t_ms, values1, values2):
+    # Groups samples into rollup records (dicts ready for insertion) for every resolution
+    records = []
+    if len(t_ms) == 0:
+        return records
+    for resolution, step in RESOLUTIONS.items():
+        buckets = t_ms - t_ms % step
+        order = np.lexsort((buckets, device_ids))
+        sorted_devices, sorted_buckets = device_ids[order], buckets[order]
+        is_new_group = np.ones(len(order), dtype=bool)
+        is_new_group[1:] = (np.diff(sorted_devices) != 0) | (np.diff(sorted_buckets) != 0)
+        starts = np.flatnonzero(is_new_group)
+
+        counts = np.diff(np.append(starts, len(order)))
+        stats1 = _value_stats(values1[order], starts)
+        stats2 = _value_stats(values2[order], starts)
+        for i, start in enumerate(starts):
+            record = {
+                'device_id': int(sorted_devices[start]),
+                'resolution': resolution,
+                'bucket_start': _ms_to_datetime(int(sorted_buckets[start])),
+                'count': int(counts[i]),
+            }
+            for suffix, stats in (('1', stats1), ('2', stats2)):
+                value_count = int(stats[0][i])
+                low, high, total, total_sq = (float(stat[i]) for stat in stats[1:])
+                record.update({
+                    'count' + suffix: value_count,
+                    'min' + suffix: None if low != low else low,
+                    'max' + suffix: None if high != high else high,
+                    'sum' + suffix: total,
+                    'sumsq' + suffix: total_sq,
+                })
+            records.append(record)
+    return records
+
+
+_STAT_COLUMNS = ('count', 'count1', 'min1', 'max1', 'sum1', 'sumsq1', 'count2', 'min2', 'max2', 'sum2', 'sumsq2')
+_ADDED_COLUMNS = ('count', 'count1', 'sum1', 'sumsq1', 'count2', 'sum2', 'sumsq2')
+
+
+def _merge_each(records):
+    # Portable version of _upsert for the other dialects (MySQL, ...): an UPDATE per bucket, and an INSERT when it
+    # didn't exist yet, in the caller's transaction. Slower, and two transactions creating the same bucket at the same
+    # time make one of them fail with an IntegrityError.
+    table = DeviceDataRollup.__table__
+    new = {column: bindparam(f'new_{column}', type_=table.c[column].type) for column in _STAT_COLUMNS}
+
+    def pick(column, smaller):
+        # Missing values (NULL) on either side keep the other one
+        current = table.c[column]
+        better = new[column] < current if smaller else new[column] > current
+        return case((current.is_(None), new[column]), (better, new[column]), else_=current)
+
+    statement = (table.update()
+                 .where(table.c.device_id == bindparam('key_device_id'), table.c.resolution == bindparam('key_resolution'),
+                        table.c.bucket_start == bindparam('key_bucket_start'))
+                 .values(**{column: table.c[column] + new[column] for column in _ADDED_COLUMNS},
+                         **{column: pick(column, smaller=True) for column in ('min1', 'min2')},
+                         **{column: pick(column, smaller=False) for column in ('max1', 'max2')}))
+    for record in records:
+        params = {f'key_{name}': record[name] for name in ('device_id', 'resolution', 'bucket_start')}
+        params.update({f'new_{column}': record[column] for column in _STAT_COLUMNS})
+        if db.session.execute(statement, params).rowcount == 0:
+            db.session.execute(table.insert(), record)
+
+
+def _upsert(records):
+    # Merges the records into the existing buckets with INSERT ... ON CONFLICT DO UPDATE where the database has it
+    table = DeviceDataRollup.__table__
+    dialect = db.session.get_bind().dialect.name
+    if dialect == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert
+        least, greatest = func.least, func.greatest
+    elif dialect == 'sqlite':
+        from sqlalchemy.dialects.sqlite import insert
+        least, greatest = func.min, func.max  # with two arguments these are the scalar versions in SQLite
+    else:
+        _merge_each(records)
+        return
+
+    statement = insert(table)
+    new = statement.excluded
+    statement = statement.on_conflict_do_update(
+        index_elements=[table.c.device_id, table.c.resolution, table.c.bucket_start],
+        set_={
+            **{column: table.c[column] + new[column] for column in _ADDED_COLUMNS},
+            # coalesce so a bucket without values doesn't turn the other side's min/max into NULL
+            **{column: least(func.coalesce(table.c[column], new[column]), func.coalesce(new[column], table.c[column])) for column in ('min1', 'min2')},
+            **{column: greatest(func.coalesce(table.c[column], new[column]), func.coalesce(new[column], table.c[column])) for column in ('max1', 'max2')},
+        },
+    )
+    db.session.execute(statement, records)
+
+
+def update_rollups(rows):
+    # Adds newly inserted DeviceData rows (dicts with device_id, timestamp, value1, value2) to the rollups.
+    # Runs in the caller's transaction, so samples and rollups are committed together.
+    if not rows:
+        return
+    records = aggregate(
+        np.array([row['device_id'] for row in rows], dtype=np.int64),
+        to_epoch_ms([row['timestamp'] for row in rows]),
+        np.array([row['value1'] for row in rows], dtype=np.float64),
+        np.array([row['value2'] for row in rows], dtype=np.float64),
+    )
+    _upsert(records)
+
+
+def rebuild_rollups(device_id=None, chunk_size=50000, progress=print):
+    # Recomputes the rollups of one device (or of all devices) from the raw samples, hot and archived. Reads the hot
+    # samples in id order, one chunk per transaction, so it can run on a live database with millions of rows: the
+    # newest id is taken in the transaction that clears the rollups, and only the rows up to it are rebuilt. Rows
+    # ingested later are added to the fresh rollups by the ingest path itself. Archiving must not run at the same time.
+    cleanup = delete(DeviceDataRollup)
+    newest = select(func.max(DeviceData.id))
+    if device_id is not None:
+        cleanup = cleanup.where(DeviceDataRollup.device_id == device_id)
+        newest = newest.where(DeviceData.device_id == device_id)
+    db.session.execute(cleanup)
+    last_rebuilt_id = db.session.execute(newest).scalar() or 0
+    db.session.commit()
+
+    last_id = 0
+    total = 0
+    while True:
+        query = (select(DeviceData.id, DeviceData.device_id, DeviceData.timestamp, DeviceData.value1, DeviceData.value2)
+                 .where(DeviceData.id > last_id, DeviceData.id <= last_rebuilt_id)
+                 .order_by(DeviceData.id)
+                 .limit(chunk_size))
+        if device_id is not None:
+            query = query.where(DeviceData.device_id == device_id)
+        rows = db.session.execute(query).all()
+        if not rows:
+            break
+
+        ids, device_ids, timestamps, values1, values2 = zip(*rows)
+        records = aggregate(np.array(device_ids, dtype=np.int64), to_epoch_ms(timestamps),
+                            np.array(values1, dtype=np.float64), np.array(values2, dtype=np.float64))
+        _upsert(records)
+        db.session.commit()
+
+        last_id = ids[-1]
+        total += len(rows)
+        progress(f'Rolled up {total} samples')
+
+    # The archived months aren't in DeviceData anymore, their chunks are rolled up one at a time
+    archived = select(DeviceDataArchive.device_id, DeviceDataArchive.month_start).order_by(DeviceDataArchive.device_id, DeviceDataArchive.month_start)
+    if device_id is not None:
+        archived = archived.where(DeviceDataArchive.device_id == device_id)
+    for archived_device_id, month in db.session.execute(archived).all():
+        data = db.session.execute(select(DeviceDataArchive.data).where(DeviceDataArchive.device_id == archived_device_id,
+                                                                       DeviceDataArchive.month_start == month)).scalar()
+        t_ms, values1, values2 = decode_chunk(data)
+        _upsert(aggregate(np.full(len(t_ms), archived_device_id, dtype=np.int64), t_ms, values1, values2))
+        db.session.commit()
+        total += len(t_ms)
+        progress(f'Rolled up {total} samples')
+    return total
+
+
+def _window_filter(query, device_id, resolution, start=None, end=None):
+    query = query.where(DeviceDataRollup.device_id == device_id, DeviceDataRollup.resolution == resolution)
+    if start is not None:
+        query = query.where(DeviceDataRollup.bucket_start >= floor_to_bucket(start, resolution))
+    if end is not None:
+        query = query.where(DeviceDataRollup.bucket_start < end)
+    return query
+
+
+def choose_resolution(device_id, start, end, max_points):
+    # Returns 'raw' unless the window holds far more samples than max_points (RAW_BUDGET_FACTOR times), and then the
+    # finest resolution whose buckets fit in max_points, provided the window has at least MIN_BUCKET_SHARE of max_points
+    # buckets with data at it. Otherwise the raw samples are loaded and downsampled, so a burst of samples in a few
+    # seconds or a window with data on a couple of days isn't drawn as a handful of averages.
+    query = _window_filter(select(func.sum(DeviceDataRollup.count), func.min(DeviceDataRollup.bucket_start)),
+                           device_id, 'day', start, end)
+    total, first_bucket = db.session.execute(query).one()
+    if not total or total <= max_points * RAW_BUDGET_FACTOR:
+        return 'raw'
+
+    window_start = start or first_bucket
+    window_end = end or datetime.now(timezone.utc)
+    if window_start.tzinfo is None:
+        window_start = window_start.replace(tzinfo=timezone.utc)
+    if window_end.tzinfo is None:
+        window_end = window_end.replace(tzinfo=timezone.utc)
+    window_ms = (window_end - window_start).total_seconds() * 1000
+    resolution = next((resolution for resolution, step in RESOLUTIONS.items() if window_ms / step <= max_points), 'day')
+    buckets = db.session.execute(_window_filter(select(func.count()).select_from(DeviceDataRollup),
+                                                device_id, resolution, start, end)).scalar()
+    return resolution if buckets >= max_points * MIN_BUCKET_SHARE else 'raw'
+
+
+def load_rollup_series(device_id, resolution, start=None, end=None):
+    # Bucket start times (epoch ms) and the mean of both values per bucket, NaN where a value is missing throughout
+    query = _window_filter(select(DeviceDataRollup.bucket_start, DeviceDataRollup.count1, DeviceDataRollup.sum1,
+                                  DeviceDataRollup.count2, DeviceDataRollup.sum2), device_id, resolution, start, end)
+    rows = db.session.execute(query.order_by(DeviceDataRollup.bucket_start)).all()
+    if not rows:
+        return np.empty(0, dtype=np.int64), np.empty(0), np.empty(0)
+
+    bucket_starts, counts1, sums1, counts2, sums2 = zip(*rows)
+    return to_epoch_ms(bucket_starts), _means(sums1, counts1), _means(sums2, counts2)
+
+
+def compare_resolution(start, end, max_points):
+    # Finest resolution whose buckets in [start, end) fit in max_points, the whole history is compared per day
+    if start is None:
+        return 'day'
+    window_end = end or datetime.now(timezone.utc)
+    if start.tzinfo is None:
+        start = start.replace(tzinfo=timezone.utc)
+    if window_end.tzinfo is None:
+        window_end = window_end.replace(tzinfo=timezone.utc)
+    window_ms = (window_end - start).total_seconds() * 1000
+    return next((resolution for resolution, step in RESOLUTIONS.items() if window_ms / step <= max_points), 'day')
+
+
+def load_compare_series(user_id, device_ids, resolution, start=None, end=None):
+    # Rollups of several devices of a user, aligned on the union of their buckets, read with a single query. The join
+    # on Device checks the ownership in the same query, devices of other users are left out. device_ids=None means
+    # every device of the user. Returns (device ids, bucket start times in epoch ms, then count, mean value1 and mean
+    # value2 as (devices, buckets) arrays), buckets without samples of a device are 0 / NaN.
+    query = (select(DeviceDataRollup.device_id, DeviceDataRollup.bucket_start, DeviceDataRollup.count,
+                    DeviceDataRollup.count1, DeviceDataRollup.sum1, DeviceDataRollup.count2, DeviceDataRollup.sum2)
+             .join(Device, Device.id == DeviceDataRollup.device_id)
+             .where(Device.user_id == user_id, DeviceDataRollup.resolution == resolution))
+    if device_ids is not None:
+        query = query.where(DeviceDataRollup.device_id.in_(device_ids))
+    if start is not None:
+        query = query.where(DeviceDataRollup.bucket_start >= floor_to_bucket(start, resolution))
+    if end is not None:
+        query = query.where(DeviceDataRollup.bucket_start < end)
+    rows = db.session.execute(query.order_by(DeviceDataRollup.device_id, DeviceDataRollup.bucket_start)).all()
+    if not rows:
+        empty = np.empty((0, 0))
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), empty, empty, empty
+
+    row_devices, bucket_starts, counts, counts1, sums1, counts2, sums2 = zip(*rows)
+    row_devices = np.array(row_devices, dtype=np.int64)
+    row_t_ms = to_epoch_ms(bucket_starts)
+    devices, device_index = np.unique(row_devices, return_inverse=True)
+    t_ms, bucket_index = np.unique(row_t_ms, return_inverse=True)
+
+    count = np.zeros((len(devices), len(t_ms)), dtype=np.int64)
+    means1 = np.full(count.shape, np.nan)
+    means2 = np.full(count.shape, np.nan)
+    count[device_index, bucket_index] = counts
+    means1[device_index, bucket_index] = _means(sums1, counts1)
+    means2[device_index, bucket_index] = _means(sums2, counts2)
+    return devices, t_ms, count, means1, means2
@@ -0,0 +1,146 @@
+# series.py
+# Loads device telemetry as NumPy column arrays (epoch milliseconds, value1, value2) for the charts
+
+from datetime import datetime, timezone
+import base64
+import struct
+
+import numpy as np
+from sqlalchemy import select, tuple_, func
+
+from . import db
+from .models import DeviceData
+from .db_access import stream_rows
+from .archive import iter_archived_months, load_archived_series
+
+
+def to_epoch_ms(timestamps):
+    # Postgres returns aware datetimes and SQLite naive UTC ones, NumPy only understands the latter
+    if timestamps and timestamps[0].tzinfo is not None:
+        timestamps = [t.astimezone(timezone.utc).replace(tzinfo=None) for t in timestamps]
+    return np.array(timestamps, dtype='datetime64[ms]').astype(np.int64)
+
+
+def to_json_list(values):
+    # NaN isn't valid JSON, missing values become null
+    return [None if value != value else value for value in np.asarray(values).tolist()]
+
+
+def encode_series_binary(t_ms, values1, values2):
+    # b'LMS1' + uint32 count, then int64 timestamps (epoch ms), float64 value1 and float64 value2, little-endian.
+    # The 8 byte header keeps the arrays aligned for typed arrays in the browser.
+    return b''.join((
+        b'LMS1' + struct.pack('<I', len(t_ms)),
+        np.ascontiguousarray(t_ms, dtype='<i8').tobytes(),
+        np.ascontiguousarray(values1, dtype='<f8').tobytes(),
+        np.ascontiguousarray(values2, dtype='<f8').tobytes(),
+    ))
+
+
+def _in_range(query, device_id, start=None, end=None):
+    # start is inclusive and end exclusive, both are matched by the (device_id, timestamp) index
+    query = query.where(DeviceData.device_id == device_id)
+    if start is not None:
+        query = query.where(DeviceData.timestamp >= start)
+    if end is not None:
+        query = query.where(DeviceData.timestamp < end)
+    return query
+
+
+def _load_hot_series(device_id, start=None, end=None):
+    # Only the three needed columns are fetched, no ORM objects are built
+    query = _in_range(select(DeviceData.timestamp, DeviceData.value1, DeviceData.value2), device_id, start, end)
+    rows = db.session.execute(query.order_by(DeviceData.timestamp)).all()
+    if not rows:
+        return np.empty(0, dtype=np.int64), np.empty(0), np.empty(0)
+
+    timestamps, values1, values2 = zip(*rows)
+    return (to_epoch_ms(timestamps),
+            np.array(values1, dtype=np.float64),
+            np.array(values2, dtype=np.float64))
+
+
+def load_device_series(device_id, start=None, end=None):
+    # Samples of both tiers, the archived months (see archive.py) and the hot DeviceData table
+    hot = _load_hot_series(device_id, start, end)
+    cold = load_archived_series(device_id, start, end)
+    if cold is None:
+        return hot
+
+    t_ms, values1, values2 = (np.concatenate(pair) for pair in zip(cold, hot))
+    if np.any(np.diff(t_ms) < 0):
+        # samples that arrived for an archived month after it was compacted are still in the hot table
+        order = np.argsort(t_ms, kind='stable')
+        t_ms, values1, values2 = t_ms[order], values1[order], values2[order]
+    return t_ms, values1, values2
+
+
+def _iter_hot_chunks(device_id, start=None, end=None, chunk_size=10000):
+    query = _in_range(select(DeviceData.timestamp, DeviceData.value1, DeviceData.value2), device_id, start, end)
+    yield from stream_rows(query.order_by(DeviceData.timestamp, DeviceData.id), chunk_size=chunk_size)
+
+
+def _archived_rows(t_ms, values1, values2):
+    return [(datetime.fromtimestamp(t / 1000, tz=timezone.utc), None if v1 != v1 else v1, None if v2 != v2 else v2)
+            for t, v1, v2 in zip(t_ms.tolist(), values1.tolist(), values2.tolist())]
+
+
+def iter_device_data_chunks(device_id, start=None, end=None, chunk_size=10000):
+    # Yields lists of (timestamp, value1, value2) rows in time order, streamed so only one chunk is in memory at a time.
+    # Archived months are merged with the hot samples that fall in the same month, then the hot table continues.
+    hot_start = start
+    for month, month_end, t_ms, values1, values2 in iter_archived_months(device_id, start, end):
+        yield from _iter_hot_chunks(device_id, hot_start, month, chunk_size)
+
+        late = _load_hot_series(device_id, max(month, start) if start else month, min(month_end, end) if end else month_end)
+        if len(late[0]):
+            t_ms, values1, values2 = (np.concatenate(pair) for pair in zip((t_ms, values1, values2), late))
+            order = np.argsort(t_ms, kind='stable')
+            t_ms, values1, values2 = t_ms[order], values1[order], values2[order]
+        for i in range(0, len(t_ms), chunk_size):
+            yield _archived_rows(t_ms[i:i + chunk_size], values1[i:i + chunk_size], values2[i:i + chunk_size])
+        hot_start = month_end
+    yield from _iter_hot_chunks(device_id, hot_start, end, chunk_size)
+
+
+def last_data_id(device_id):
+    return db.session.execute(select(func.max(DeviceData.id)).where(DeviceData.device_id == device_id)).scalar() or 0
+
+
+def load_new_points(device_id, after_id, limit=1000):
+    # Rows of a device written after the row after_id, oldest first, as dicts (id, device_id, timestamp, value1, value2)
+    query = (select(DeviceData.id, DeviceData.device_id, DeviceData.timestamp, DeviceData.value1, DeviceData.value2)
+             .where(DeviceData.device_id == device_id, DeviceData.id > after_id)
+             .order_by(DeviceData.id)
+             .limit(limit))
+    return [row._asdict() for row in db.session.execute(query)]
+
+
+def encode_cursor(timestamp, data_id):
+    return base64.urlsafe_b64encode(f'{timestamp.isoformat()}|{data_id}'.encode()).decode()
+
+
+def decode_cursor(cursor):
+    # Raises ValueError for cursors that weren't made by encode_cursor
+    try:
+        timestamp, data_id = base64.urlsafe_b64decode(cursor.encode()).decode().split('|')
+        return datetime.fromisoformat(timestamp), int(data_id)
+    except (ValueError, UnicodeError) as e:
+        raise ValueError('Invalid cursor') from e
+
+
+def page_device_data(device_id, start=None, end=None, cursor=None, limit=1000):
+    # Keyset pagination on (timestamp, id): each page continues right after the last row of the previous one,
+    # so deep pages cost the same as the first one (no OFFSET).
+    # Returns the rows (id, timestamp, value1, value2) and the cursor of the next page, or None on the last page.
+    query = _in_range(select(DeviceData.id, DeviceData.timestamp, DeviceData.value1, DeviceData.value2), device_id, start, end)
+    if cursor is not None:
+        after_timestamp, after_id = decode_cursor(cursor)
+        query = query.where(tuple_(DeviceData.timestamp, DeviceData.id) > (after_timestamp, after_id))
+    rows = db.session.execute(query.order_by(DeviceData.timestamp, DeviceData.id).limit(limit + 1)).all()
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(rows[-1].timestamp, rows[-1].id)
+    return rows, next_cursor
@@ -7,7 +7,6 @@ import json
 # 
 from flask_wtf.csrf import generate_csrf # CSRF protection for contact form
 from flask import request, redirect, url_for, flash, render_template
-from flask_mail import Message
 
 views = Blueprint('views', __name__)
 